@@ -10,10 +10,16 @@ TODO Distance: print distance name
 
 from __future__ import print_function, unicode_literals
 
+import argparse
+import datetime
 import fileinput
-import string
+import sys
 
-from src.edpath import Distance
+from src import costs, edpath
+from src.edpath import Distance, PathCache
+from src.filecache import FileCache, MemCache
+from src.galaxy import import_dump
+from src.resolver import CoordsCache
 
 
 def wrap_to_profile(func):
@@ -33,11 +39,119 @@ def wrap_to_profile(func):
     return _wrap
 
 
+def cache_main(argv):
+    """edmain.py cache ...: maintenance of the file cache"""
+    parser = argparse.ArgumentParser(prog='edmain.py cache', description='File cache maintenance')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('stats', help='entries and size of every namespace')
+    prune = commands.add_parser('prune', help='remove stale entries, then old or over the size')
+    prune.add_argument('--namespace', default=PathCache.NAMESPACE,
+                       help='namespace to prune by age and size')
+    prune.add_argument('--max-age', type=float, help='days')
+    prune.add_argument('--max-mb', type=float, help='size of the namespace')
+    commands.add_parser('compact', help='shrink the cache file')
+    commands.add_parser('import', help='import old %s tree' % FileCache.CACHE_DIR)
+    galaxy = commands.add_parser('galaxy', help='build offline index of systems from EDSM dump')
+    galaxy.add_argument('dump', help='systemsWithCoordinates.json, may be gzipped')
+    warm = commands.add_parser('warm', help='load systems and best path of routes')
+    warm.add_argument('--cost', choices=sorted(costs.COSTS), default=edpath.COST,
+                      help='minimize light years, jumps or travel time')
+    warm.add_argument('--jump-range', type=float, default=costs.JUMP_RANGE,
+                      help='jump range of the ship for jumps and time costs, ly')
+    warm.add_argument('files', nargs='+', help='route files')
+    args = parser.parse_args(argv)
+
+    versions = {CoordsCache.NAMESPACE: CoordsCache.VERSION, PathCache.NAMESPACE: PathCache.VERSION}
+    if args.command == 'stats':
+        for namespace, stat in sorted(FileCache.stats(versions).items()):
+            print('%-8s entries %6d, %8.1f KB, stale %6d, oldest %s' % (
+                namespace, stat['entries'], stat['bytes'] / 1024.0, stat['stale'],
+                datetime.datetime.fromtimestamp(stat['oldest']).strftime('%Y-%m-%d')))
+    elif args.command == 'prune':
+        removed = FileCache.prune(args.namespace, versions,
+                                  max_age=args.max_age * 24 * 3600 if args.max_age is not None else None,
+                                  max_bytes=args.max_mb * 1024 * 1024 if args.max_mb is not None else None)
+        print('Removed %d entries' % removed)
+    elif args.command == 'compact':
+        FileCache.compact()
+    elif args.command == 'import':
+        print('Imported %d entries' % FileCache.import_tree())
+    elif args.command == 'galaxy':
+        print('Imported %d systems' % import_dump(args.dump))
+    elif args.command == 'warm':
+        edpath.PATH_CACHE = True
+        edpath.COST = args.cost
+        costs.JUMP_RANGE = args.jump_range
+        for each in args.files:
+            with open(each) as f:
+                route = Distance(f.read())
+            found_len, _ = route.best_path()
+            print('%s: %.2f %s' % (each, found_len, costs.UNITS.get(route.cost, '')))
+        FileCache.flush()
+
+
 if __name__ == '__main__':
-    mypath = Distance(string.join(fileinput.input()))
+    if sys.argv[1:2] == ['cache']:
+        cache_main(sys.argv[2:])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='Elite Dangerous route planner')
+    parser.add_argument('--workers', type=int, default=edpath.WORKERS,
+                        help='number of worker processes to search with')
+    parser.add_argument('--method', choices=['split', 'bnb', 'exact', 'fast', 'local'],
+                        default=edpath.METHOD, help='search method')
+    parser.add_argument('--fast', action='store_true',
+                        help='heuristic path only, for huge lists')
+    parser.add_argument('--time-budget', type=float, default=edpath.TIME_BUDGET,
+                        help='seconds to improve path with local search method')
+    parser.add_argument('--split-points', type=int, default=edpath.SPLIT_POINTS,
+                        help='search only this number of most promising split positions, '
+                             'off by default. 3 is about 10 times faster, path may be a bit longer')
+    parser.add_argument('--candidates', type=int, default=edpath.CANDIDATES,
+                        help='try only this number of nearest poi as the next hop, faster for long routes')
+    parser.add_argument('--cost', choices=sorted(costs.COSTS), default=edpath.COST,
+                        help='minimize light years, jumps or travel time')
+    parser.add_argument('--jump-range', type=float, default=costs.JUMP_RANGE,
+                        help='jump range of the ship for jumps and time costs, ly')
+    parser.add_argument('--neutron-boost', type=float, default=costs.NEUTRON_BOOST,
+                        help='jump range multiplier of neutron stars (4), long legs are boosted')
+    parser.add_argument('--minor-budget', type=float, default=None,
+                        help='visit only minor poi (marked with _) which add no more than this cost together')
+    parser.add_argument('--minor-detour', type=float, default=None,
+                        help='visit only minor poi which add no more than this cost each')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='shuffle poi with this seed instead of ordering them along the path')
+    parser.add_argument('--cache-mb', type=int, default=MemCache.MAX_BYTES // 1024 // 1024,
+                        help='memory for cached sub paths, least valuable are evicted')
+    parser.add_argument('--no-path-cache', action='store_true',
+                        help='do not read or store best path of the route in the file cache')
+    parser.add_argument('files', nargs='*', help='route files, read stdin when empty')
+    args = parser.parse_args()
+
+    edpath.WORKERS = args.workers
+    edpath.METHOD = 'fast' if args.fast else args.method
+    edpath.TIME_BUDGET = args.time_budget
+    edpath.SPLIT_POINTS = args.split_points
+    edpath.CANDIDATES = args.candidates
+    edpath.COST = args.cost
+    costs.JUMP_RANGE = args.jump_range
+    costs.NEUTRON_BOOST = args.neutron_boost
+    MemCache.MAX_BYTES = args.cache_mb * 1024 * 1024
+    edpath.PATH_CACHE = not args.no_path_cache
+
+    mypath = Distance(fileinput.input(args.files), seed=args.seed)
 
     print('Direct path is %.2f ly' % mypath.direct_length)
 
-    mypath.print_path(mypath.best_path()[-1])
+    if args.minor_budget is None and args.minor_detour is None:
+        best = mypath.best_path()
+        if edpath.METHOD in ('fast', 'local', 'exact'):
+            mypath.print_gap()
+    else:
+        best = mypath.best_path_with_minor(args.minor_budget, args.minor_detour)
+        if mypath.dropped:
+            print('Skipped minor poi: %s' % ', '.join([x.alias for x in mypath.dropped]))
+
+    mypath.print_path(best[-1], mypath.cost)
 
     mypath.print_cache_hit_histogram()
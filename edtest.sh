@@ -3,12 +3,12 @@
 i=2
 CFG=WP7TO8.txt
 
-find .edpathcache -type f | xargs grep -l found_len | xargs rm
+python -c "from src.filecache import FileCache; FileCache.clear('paths')"
 cat $CFG | python edmain.py > 1
 
 while ((i>0)); do
     echo $i
-    find .edpathcache -type f | xargs grep -l found_len | xargs rm
+    python -c "from src.filecache import FileCache; FileCache.clear('paths')"
     cat $CFG | time python edmain.py | diff 1 -
     if [[ $? -ne 0 ]]; then
         i=0
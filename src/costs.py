@@ -0,0 +1,59 @@
+"""
+Cost of the legs for the solvers: light years, jumps or travel time
+
+Cost function takes numpy array of leg lengths in ly and returns array
+of costs, it is applied once to the whole distance matrix.
+"""
+from __future__ import print_function
+
+import numpy
+
+# ship jump range, ly
+JUMP_RANGE = 50.0
+# jump range multiplier of neutron boost, None when neutron stars are not used
+NEUTRON_BOOST = None
+# extra jumps to get to neutron stars on the way of boosted leg
+NEUTRON_DETOUR = 2
+# seconds for one jump, from charging frame shift drive to next charge
+JUMP_SECONDS = 45
+# seconds to find and scan poi after arrival to the system
+LEG_SECONDS = 120
+
+
+def distance(lengths):
+    """Straight line ly"""
+    return lengths
+
+
+def jumps(lengths):
+    """Number of jumps, boosted by neutron stars when it needs fewer jumps"""
+    lengths = numpy.asarray(lengths, dtype=numpy.float64)
+    ret = numpy.ceil(lengths / JUMP_RANGE)
+    if NEUTRON_BOOST:
+        boosted = numpy.ceil(lengths / (JUMP_RANGE * NEUTRON_BOOST)) + NEUTRON_DETOUR
+        ret = numpy.minimum(ret, boosted)
+
+    return numpy.where(lengths > 0, ret, 0)
+
+
+def travel_time(lengths):
+    """Seconds to jump to the poi and find it there"""
+    lengths = numpy.asarray(lengths, dtype=numpy.float64)
+    return jumps(lengths) * JUMP_SECONDS + numpy.where(lengths > 0, LEG_SECONDS, 0)
+
+
+COSTS = {'distance': distance,
+         'jumps': jumps,
+         'time': travel_time}
+
+UNITS = {'distance': 'ly',
+         'jumps': 'jumps',
+         'time': 's'}
+
+
+def tag(name):
+    """Name of the cost model with its settings, for cache keys"""
+    if name == 'distance':
+        return name
+    return '%s@%g/%s/%d/%d/%d' % (name, JUMP_RANGE, NEUTRON_BOOST, NEUTRON_DETOUR,
+                                  JUMP_SECONDS, LEG_SECONDS)
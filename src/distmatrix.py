@@ -0,0 +1,84 @@
+"""
+Pairwise distances between systems, computed once per path
+"""
+from __future__ import print_function
+
+import numpy
+
+from src import costs
+
+
+class DistanceMatrix(object):
+    """
+    Dense float64 matrix of distances between points with x, y, z
+
+    array and rows hold cost of the legs for the solvers: cost function
+    (see src.costs) of the distances, distance() is always in ly.
+    """
+    def __init__(self, points, cost=None):
+        # name in costs.COSTS or function of the distances
+        self.cost = cost or 'distance'
+        function = costs.COSTS.get(self.cost, self.cost)
+        if not callable(function):
+            raise ValueError('Unknown cost %s' % self.cost)
+
+        self._points = list(points)
+        # Coords have no name, so points are matched by identity
+        self._index = {id(each): indx for indx, each in enumerate(self._points)}
+
+        coords = numpy.array([(each.x, each.y, each.z) for each in self._points],
+                             dtype=numpy.float64).reshape(-1, 3)
+        square = numpy.zeros((len(coords), len(coords)))
+        # one axis at a time keeps memory at N^2 instead of N^2 * 3
+        for axis in range(3):
+            diff = coords[:, axis, numpy.newaxis] - coords[numpy.newaxis, :, axis]
+            square += diff * diff
+        lengths = numpy.sqrt(square)
+        if function is costs.distance:
+            self.array = lengths
+        else:
+            self.array = numpy.asarray(function(lengths), dtype=numpy.float64)
+
+        # nested lists are much faster than numpy for access by single element,
+        # rows are costs and lengths are ly
+        self.rows = self.array.tolist()
+        self.lengths = self.rows if self.array is lengths else lengths.tolist()
+
+    def __len__(self):
+        return len(self._points)
+
+    @property
+    def points(self):
+        return self._points
+
+    def index(self, point):
+        """Get position of the point in the matrix"""
+        return self._index[id(point)]
+
+    def distance(self, a, b):
+        """Get distance between two points in ly"""
+        return self.lengths[self._index[id(a)]][self._index[id(b)]]
+
+    def leg_cost(self, a, b):
+        """Get cost of the leg between two points"""
+        return self.rows[self._index[id(a)]][self._index[id(b)]]
+
+    def sub(self, indices):
+        """Get square sub matrix for given positions"""
+        return self.array[numpy.ix_(indices, indices)]
+
+    def mst_length(self, indices):
+        """Length of minimum spanning tree over given positions (Prim)"""
+        if len(indices) < 2:
+            return 0
+
+        rest = list(indices[1:])
+        edge = [self.rows[indices[0]][x] for x in rest]
+        total = 0
+        while rest:
+            nearest = min(range(len(edge)), key=edge.__getitem__)
+            total += edge.pop(nearest)
+            row = self.rows[rest.pop(nearest)]
+            edge = [min(d, row[x]) for d, x in zip(edge, rest)]
+
+        return total
@@ -5,42 +5,132 @@ Find shortest path between two systems while visiting all POI in between
 from __future__ import print_function, unicode_literals
 
 import copy
+import ctypes
 import datetime
 import json
 import math
+import multiprocessing
 import random
-import threading
 import time
+from array import array
 from collections import namedtuple
 
+from src import costs, routefile
+from src.distmatrix import DistanceMatrix
 from src.edsystems import System, mSystem
-from src.filecache import NoCache, FileCache, MemCache
+from src.filecache import FileCache, MemCache
+from src.heldkarp import HELD_KARP_MAX, held_karp
+from src.heuristics import EPSILON, heuristic_path
+from src.kdtree import KDTree
+from src.localsearch import local_search
 
 DEBUG = False
 DEBUG_LEVELS = [0]
 
 # Tunables
-THREADS = False
+# number of worker processes for the top level search, 0 runs in this process
+WORKERS = 0
 # when start split into half. 5 is the optimal
 SPLIT_LOW_LIMIT = 5
+# number of split positions to search, ranked by heuristic path length,
+# None searches all of them. Opt-in: 3 is about 10 times faster on 22-28
+# system routes and found the same path on 9 of 10 of them
+SPLIT_POINTS = None
+# default search method, see _BaseDistance.best_path
+METHOD = 'split'
+# seconds to improve path with method 'local'
+TIME_BUDGET = 10
+# from this number of poi start with heuristic path and check lower bounds
+# of the rest of the path
+BOUND_MIN = 6
+# number of nearest poi allowed as the next hop in branch and bound (finish
+# is always allowed), None allows all. When no path is found this way,
+# all poi are searched. Path is not guaranteed shortest then
+CANDIDATES = None
+# cache sub paths with this number of poi
+CACHE_MIN = 3
+CACHE_MAX = 36
+# store best paths of whole routes in the file cache
+PATH_CACHE = False
+# version of the cached paths, increase when search finds other paths
+SOLVER_VERSION = 2
+# cost of the legs to minimize, see src.costs
+COST = 'distance'
+# max number of proven lower bounds of sub paths, all are dropped when reached
+LOWER_BOUNDS_MAX = 100000
+
+
+# distance to search in the worker process
+_WORKER = None
+
+# interned ids of system names, shared by all paths so that cache keys
+# of sub paths match between legs
+_SYSTEM_IDS = {}
+
+# no path of the sub path is shorter than this, proven by a search with
+# a limit which found nothing. Kept apart from MemCache so that bound
+# lookups do not count as cache reads
+_LOWER_BOUNDS = {}
+
+
+def _system_id(name):
+    return _SYSTEM_IDS.setdefault(name, len(_SYSTEM_IDS))
+
+
+def _init_worker(dist, bound):
+    global _WORKER
+    _WORKER = dist
+    _WORKER._bound = bound
+
+
+class _Bound(object):
+    """Length of the best path found so far, read by every branch of the search"""
+    def __init__(self, shared=False):
+        if shared:
+            # reads are lock free, only updates are serialized
+            self._lock = multiprocessing.Lock()
+            self._value = multiprocessing.RawValue('d', 0)
+        else:
+            self._lock = None
+            self._value = ctypes.c_double(0)
+
+    @property
+    def value(self):
+        return self._value.value
+
+    @value.setter
+    def value(self, length):
+        self._value.value = length
+
+    def update(self, length):
+        """Set bound to length if it is shorter"""
+        if self._lock:
+            with self._lock:
+                self._update(length)
+        else:
+            self._update(length)
+
+    def _update(self, length):
+        if not self._value.value or length < self._value.value:
+            self._value.value = length
 
-CACHE_TYPE = {0: NoCache,
-              1: MemCache,
-              2: FileCache}
 
+def _split_worker(args):
+    return _WORKER._run_task(_WORKER._split_task, *args)
 
-class _T_Distance(threading.Thread):
-    def __init__(self, dist):
-        super(_T_Distance, self).__init__()
-        assert isinstance(dist, Distance)
-        self._dist = dist
-        self.best = None
 
-    def run(self):
-        self.best = self._dist.best_path()
+def _hop_worker(args):
+    return _WORKER._run_task(_WORKER._hop_task, *args)
 
 
-COLS = ('Name', 'Next', 'Path', 'Last')
+class PathCache(FileCache):
+    """Best paths of routes, keyed by method and names of the systems"""
+    NAMESPACE = 'paths'
+    VERSION = SOLVER_VERSION
+
+
+# Cost is printed for other costs than distance
+COLS = ('Name', 'Next', 'Path', 'Last', 'Cost')
 Table = namedtuple('Table', COLS)
 Table.__new__.__defaults__ = ('-',) * len(COLS)
 
@@ -48,8 +138,11 @@ Table.__new__.__defaults__ = ('-',) * len(COLS)
 class _BaseDistance(MemCache):
     """
     Distance from A to B with every POI unique (no duplicates)
+
+    Search works with positions of systems in the distance matrix,
+    System objects are only used for the result.
     """
-    def __init__(self, dist, name=None):
+    def __init__(self, dist, name=None, matrix=None, cost=None):
         self.name = name
 
         assert isinstance(dist, list)
@@ -57,6 +150,20 @@ class _BaseDistance(MemCache):
             raise ValueError('distance must be two or more poi')
 
         self._path = copy.copy(dist)
+        # sub paths share the matrix of the parent, and cost of the legs with it
+        self._matrix = matrix if matrix is not None else DistanceMatrix(self._path, cost or COST)
+        self.cost = self._matrix.cost
+        # in cache keys, function can not be stored in the file cache
+        self._cost_tag = costs.tag(self.cost) if self.cost in costs.COSTS else self.cost
+        # Coords have no name and can not be cached
+        self._names = [getattr(x, 'name', None) for x in self._matrix.points]
+        self._position = {x: indx for indx, x in enumerate(self._names)}
+        if None in self._names:
+            self._ids = None
+        else:
+            self._ids = [_system_id(x) for x in self._names]
+            self._bits = [1 << x for x in self._ids]
+            self._id_position = {x: indx for indx, x in enumerate(self._ids)}
 
         # swap: system marked with * is the real start
         # for indx, elem in enumerate(self.path):
@@ -64,18 +171,7 @@ class _BaseDistance(MemCache):
         #         # self.path[0], self.path[indx] = self.path[indx], self.path[0]
         #         break
 
-        # Cache tunables (len of poi)
-        CACHE_MIN = 3
-        CACHE_MAX = 36
-
-        # set file cache
-        if CACHE_MIN <= len(self.poi) <= CACHE_MAX:
-            arr = [self.start.name] + sorted([each.name for each in self.poi]) + [self.finish.name]
-            cache_name = ';'.join(arr)
-        else:
-            cache_name = None
-
-        super(_BaseDistance, self).__init__(cache_name=cache_name)
+        super(_BaseDistance, self).__init__(cache_name=None)
 
         # path counted until the end
         self.pcount = 0
@@ -83,34 +179,61 @@ class _BaseDistance(MemCache):
         # path rejected early
         self.rcount = 0
 
+        # path rejected because other branch found shorter path (part of rcount)
+        self.bcount = 0
+
+        # path rejected by lower bound of the rest of the path (part of rcount),
+        # cached is lower bound proven by earlier search of the same sub path,
+        # candidates are hops to poi which are not between the nearest ones
+        self.rejected = {'nearest': 0, 'mst': 0, 'cached': 0, 'candidates': 0}
+
+        # split heuristic is off for exact branch and bound
+        self._split_low_limit = SPLIT_LOW_LIMIT
+
+        # length of the last found path and proven lower bound for it
+        self.found_len = None
+        self.lower_bound = None
+
+        # None searches poi in the order along the path, else shuffled with this seed
+        self.seed = None
+
         self.level = 0
         # we need this value for the case when we skip minor poi
         self.poi_len = len(self) - 2
 
+        # worker processes and best path length shared with them
+        self._pool = None
+        self._bound = None
+
     def print(self, *args):
         if DEBUG and self.level in DEBUG_LEVELS:
             print(' ' * self.level, *args)
 
     @staticmethod
-    def _make_table(path):
-        table = [Table(*COLS)]
-
+    def _make_table(path, cost=None):
+        matrix = DistanceMatrix(path, cost)
+        width = len(COLS) if matrix.cost != 'distance' else len(COLS) - 1
+        unit = costs.UNITS.get(matrix.cost, '')
+        table = [Table(*COLS)[:width]]
+
+        legs = [matrix.distance(path[n], path[n + 1]) for n in range(len(path) - 1)]
+        leg_costs = [matrix.leg_cost(path[n], path[n + 1]) for n in range(len(path) - 1)]
         for n, curr in enumerate(path):
             if n < len(path) - 1:
-                to_last = _BaseDistance(path[n:])
                 table.append(Table(curr.alias,
-                                   '{: 5.2f} ly'.format(curr.distance_to(path[n + 1])),
-                                   '{: 5.2f} ly'.format(to_last.len_path_asis),
-                                   '{: 5.2f} ly'.format(to_last.direct_length)
-                                   ))
+                                   '{: 5.2f} ly'.format(legs[n]),
+                                   '{: 5.2f} ly'.format(sum(legs[n:])),
+                                   '{: 5.2f} ly'.format(matrix.distance(curr, path[-1])),
+                                   '{:g} / {:g} {}'.format(leg_costs[n], sum(leg_costs[n:]), unit)
+                                   )[:width])
             else:
-                table.append(Table(curr.alias))
+                table.append(Table(curr.alias)[:width])
 
         return table
 
     @staticmethod
     def _make_tlen(table):
-        tlen = [0] * len(COLS)
+        tlen = [0] * len(table[0])
         for each in table:
             for indx, elem in enumerate(each):
                 tlen[indx] = max(tlen[indx], len(elem))
@@ -118,8 +241,9 @@ class _BaseDistance(MemCache):
         return tlen
 
     @staticmethod
-    def print_path(best_path):
-        table = _BaseDistance._make_table(best_path)
+    def print_path(best_path, cost=None):
+        """Print table of the path, with cost of the legs when cost is not distance"""
+        table = _BaseDistance._make_table(best_path, cost)
         tlen = _BaseDistance._make_tlen(table)
         sep = ['-' * each for each in tlen]
         table.append(sep)
@@ -135,9 +259,34 @@ class _BaseDistance(MemCache):
     def print_stats(self):
         print('Total %d! combinations' % self.poi_len)
         print('Paths considered: %d, paths rejected early %d' % (self.pcount, self.rcount))
+        print('Paths rejected by bound shared between branches: %d' % self.bcount)
+        print('Paths rejected by lower bound: nearest %d, mst %d, cached %d' % (
+            self.rejected['nearest'], self.rejected['mst'], self.rejected['cached']))
+        print('Paths skipped by candidate lists: %d' % self.rejected['candidates'])
         total = math.factorial(self.poi_len)
         print('Paths not even considered: %d of %d' % (total - self.rcount - self.pcount, total))
-        print('Optmizitaion %.1f (more is better)' % (100.0 * self.rcount / total))
+        # integer division, factorial of long path does not fit into float
+        print('Optmizitaion %.1f (more is better)' % (1000 * self.rcount // total / 10.0))
+
+        self.print_gap()
+
+    def gap(self):
+        """Lower bound of the last found path and gap to it in percent, None before search"""
+        if not self.found_len:
+            return None
+
+        # any path visits every system, so it is a spanning tree
+        lower_bound = self.lower_bound or self._matrix.mst_length(self._indices())
+        if not lower_bound:
+            return lower_bound, 0.0
+        return lower_bound, 100.0 * (self.found_len - lower_bound) / lower_bound
+
+    def print_gap(self):
+        gap = self.gap()
+        if gap:
+            unit = costs.UNITS.get(self.cost, '')
+            print('Found path %.2f %s, lower bound %.2f %s, gap %.1f%%' % (self.found_len, unit,
+                                                                         gap[0], unit, gap[1]))
 
     @property
     def start(self):
@@ -157,7 +306,7 @@ class _BaseDistance(MemCache):
 
     @property
     def direct_length(self):
-        return self.start.distance_to(self.finish)
+        return self._matrix.distance(self.start, self.finish)
 
     def __iter__(self):
         for _i in range(len(self) - 1):
@@ -165,151 +314,429 @@ class _BaseDistance(MemCache):
 
     @property
     def len_path_asis(self):
-        return sum([a.distance_to(b) for (a, b) in self])
+        return self._path_len(self._indices())
+
+    def _indices(self):
+        return array('H', [self._matrix.index(x) for x in self._path])
+
+    def _systems(self, order):
+        return [self._matrix.points[x] for x in order]
+
+    def _path_len(self, order):
+        rows = self._matrix.rows
+        return sum([rows[order[i]][order[i + 1]] for i in range(len(order) - 1)])
+
+    def _route_name(self, method):
+        """
+        Name of the route in the path cache, None if it can not be cached
+
+        Name holds every setting which changes the path found by the method.
+        Path of 'local' depends on time budget and speed of the machine, it
+        is never cached.
+        """
+        names = [x.name for x in self._path] if self._ids is not None else None
+        if not names:
+            return None
+
+        if self.cost not in costs.COSTS or method == 'local':
+            return None
+        if method == 'split':
+            # split positions depend on the order of poi
+            method = '%s/%s/%s/%s' % (method, SPLIT_POINTS, SPLIT_LOW_LIMIT, self.seed)
+        if CANDIDATES:
+            method = '%s/%d' % (method, CANDIDATES)
+        if self.cost != 'distance':
+            method = '%s/%s' % (method, self._cost_tag)
+        return ';'.join([method, names[0]] + sorted(names[1:-1]) + [names[-1]]).encode('utf-8')
+
+    def _sub_cache_key(self, start, poi, finish):
+        """
+        Cache key of the sub path: ids of the ends, bitmask of poi ids and cost.
+
+        Path from finish to start has the same key, second value tells
+        that the cached path has to be reversed.
+        """
+        if self._ids is None or not CACHE_MIN <= len(poi) <= CACHE_MAX:
+            return None, False
+
+        first, last = self._ids[start], self._ids[finish]
+        mask = sum([self._bits[x] for x in poi])
+        if first > last:
+            return (last, first, mask, self._cost_tag), True
+
+        return (first, last, mask, self._cost_tag), False
+
+    def best_path(self, limit=0, method=None):
+        """
+        Find shortest path A->..->Z
+
+        method 'split' is branch and bound with split heuristic,
+        method 'bnb' is branch and bound without split (guaranteed optimum),
+        method 'exact' is Held-Karp dynamic programming (guaranteed optimum),
+        method 'fast' is nearest neighbour path improved by 2-opt and or-opt,
+        method 'local' is 'fast' improved further for TIME_BUDGET seconds
+
+        'exact' falls back to 'local' for more than HELD_KARP_MAX poi,
+        exponential search would run for hours then.
+        """
+        method = method or METHOD
+        if method == 'exact' and self.len_poi > HELD_KARP_MAX:
+            print('Too many poi for exact method: %d > %d, using local search for %g s instead' % (
+                self.len_poi, HELD_KARP_MAX, TIME_BUDGET))
+            method = 'local'
+        cache = PathCache(self._route_name(method) if PATH_CACHE and not limit else None)
+        with cache.open() as f:
+            cached = self.from_dict(json.load(f)) if f else None
+
+        if cached:
+            found_len, found_best = cached[0], self._systems(cached[1])
+        elif method == 'exact':
+            found_len, found_best = self.__best_path_exact()
+        elif method == 'fast':
+            found_len, found_best = self.__best_path_fast()
+        elif method == 'local':
+            found_len, found_best = self.__best_path_local()
+        elif method == 'split':
+            self._split_low_limit = SPLIT_LOW_LIMIT
+            found_len, found_best = self.__best_path_search(limit)
+        elif method == 'bnb':
+            # cache is not used: it may hold a result of the split heuristic
+            self._split_low_limit = None
+            found_len, found_best = self.__best_path_search(limit)
+        else:
+            raise ValueError('Unknown method %s' % method)
+
+        if found_best:
+            if not cached:
+                cache.save(json.dumps(self.to_dict(found_len, [self._matrix.index(x) for x in found_best])))
+            self.found_len = found_len
+            if method == 'exact' or (method == 'bnb' and not CANDIDATES):
+                self.lower_bound = found_len
 
-    def best_path(self, limit=0):
-        # find first path A->..->Z
+        return found_len, found_best
+
+    def __best_path_search(self, limit):
+        idx = self._indices()
+        if WORKERS > 1 and len(self) > 3:
+            self._bound = _Bound(shared=True)
+            self._pool = multiprocessing.Pool(WORKERS, initializer=_init_worker,
+                                              initargs=(self, self._bound))
+        try:
+            found_len, found_best = self._best_path(idx[0], tuple(idx[1:-1]), idx[-1],
+                                                    limit, self.level)
+        finally:
+            if self._pool:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool, self._bound = None, None
+
+        if found_best:
+            return found_len, self._systems(found_best)
+        else:
+            return found_len, None
 
+    def _best_path(self, start, poi, finish, limit=0, level=0):
         # if no poi
+        if len(poi) <= 1:
+            self.pcount += 1
+            order = (start,) + poi + (finish,)
+            return self._path_len(order), order
+
+        if self._split_low_limit:
+            key, reverse = self._sub_cache_key(start, poi, finish)
+        else:
+            key, reverse = None, False
+        cache = MemCache(None, key=key)
+        f = cache.read()
+        if f:
+            # cached path is a tuple of system ids
+            found_len, ids = f
+            found_best = tuple([self._id_position[x] for x in ids])
+            return found_len, found_best[::-1] if reverse else found_best
+
+        lower_bound = _LOWER_BOUNDS.get(key) if key and limit else None
+        if lower_bound and limit <= lower_bound:
+            self.rcount += math.factorial(len(poi))
+            self.rejected['cached'] += math.factorial(len(poi))
+            return limit, None
+
+        _start = time.time()
+        if self._split_low_limit and len(poi) + 2 > self._split_low_limit:
+            found_len, found_best = self.__best_path_with_split(start, poi, finish, level)
+        else:
+            found_len, found_best = self.__best_path(start, poi, finish, limit, level)
+        _finish = time.time()
+
+        if found_best:
+            ids = tuple([self._ids[x] for x in found_best])
+            cache.save((found_len, ids[::-1] if reverse else ids),
+                       time_spent=((_finish - _start) * math.factorial(len(poi))))
+        elif limit and key:
+            # search with a limit failed, limit is above the known bound
+            if len(_LOWER_BOUNDS) >= LOWER_BOUNDS_MAX:
+                _LOWER_BOUNDS.clear()
+            _LOWER_BOUNDS[key] = limit
+
+        return found_len, found_best
+
+    def __best_path_exact(self):
+        # cache is not used: it may hold a result of the split heuristic
         if len(self) <= 3:
             self.pcount += 1
-            self.print('short path, returning')
             return self.len_path_asis, self._path
-        else:
-            f = self.read()
 
-            start = time.time()
-            if f:
-                return self.from_dict(json.loads(f))
-            elif len(self) > SPLIT_LOW_LIMIT:
-                found_len, found_best = self.__best_path_with_split()
-            else:
-                found_len, found_best = self.__best_path(limit)
-            finish = time.time()
+        idx = self._indices()
+        found_len, order = held_karp(self._matrix.sub(idx))
+        self.pcount += 1
+
+        return found_len, [self.start] + [self._path[x] for x in order] + [self.finish]
+
+    def __best_path_fast(self):
+        idx = self._indices()
+        found_len, found_best = heuristic_path(self._matrix.rows, idx[0], idx[1:-1], idx[-1])
+        self.pcount += 1
+
+        return found_len, self._systems(found_best)
 
-            if found_best:
-                self.save(json.dumps(self.to_dict(found_len,
-                                                  found_best)),
-                          time_spent=((finish - start) * math.factorial(self.len_poi)))
+    def __best_path_local(self):
+        if len(self) <= 3:
+            self.pcount += 1
+            return self.len_path_asis, self._path
 
-            return found_len, found_best
+        idx = self._indices()
+        found_len, order = local_search(self._matrix.sub(idx), 0, tuple(range(1, len(idx) - 1)),
+                                        len(idx) - 1, TIME_BUDGET, seed=self.seed or 0)
+        self.pcount += 1
+
+        return found_len, [self._path[x] for x in order]
 
     def from_dict(self, data):
         found_len = data['found_len']
-        found_best = []
-        for each in data['found_best']:
-            system = [x for x in self._path if x.name == each]
-            try:
-                assert len(system) == 1, each
-            except AssertionError:
-                print(system)
-                raise
-            found_best.append(system[0])
+        found_best = tuple([self._position[each] for each in data['found_best']])
 
         return found_len, found_best
 
     def to_dict(self, path_len, path):
         return {'found_len': path_len,
-                'found_best': [x.name for x in path]}
+                'found_best': [self._names[x] for x in path]}
 
     def __getitem__(self, key):
         return self._path[key]
 
-    def __setitem__(self, key, value):
-        self._path[key] = value
-
-    def _swap(self, key1, key2):
-        self[key1], self[key2] = self[key2], self[key1]
-
-    def __best_path(self, limit=0):
-        # for every poi
+    def _candidates(self, start, poi):
+        """CANDIDATES nearest poi for start and every poi, nearest first"""
+        if self.cost not in costs.COSTS:
+            # cost function may not grow with the distance
+            rows = self._matrix.rows
+            return {x: sorted([y for y in poi if y != x], key=rows[x].__getitem__)[:CANDIDATES]
+                    for x in (start,) + poi}
+
+        # every cost of src.costs grows with the distance, nearest in ly are the cheapest
+        tree = KDTree(self._systems(poi))
+        points = self._matrix.points
+        return {x: [poi[y] for _, y in tree.nearest(points[x], CANDIDATES + 1) if poi[y] != x][:CANDIDATES]
+                for x in (start,) + poi}
+
+    def __best_path(self, start, poi, finish, limit=0, level=None, offset=None):
+        """
+        Try all permutations of poi in place, reject early when too long
+
+        offset is length of the path before start, when set the shared bound
+        is checked before every jump
+        """
+        rows = self._matrix.rows
         found_best = None
 
-        self.print('Starting with path len:', self.len_path_asis)
-        if limit == 0:
-            limit = self.len_path_asis
-            found_best = copy.copy(self.path)
-
-        # this array we try all combinations
-        sub_path = _BaseDistance(self._path[1:])
-        sub_path.level = self.level + 2
-
-        self.print('starting best path # of len:', len(sub_path))
-
-        # try all combinations (exclude finish)
-        for indx in range(1, len(sub_path)):
-            self.print('indx', indx, sub_path.start)
-            # next distance on this path (excluding self.start)
-            # print(best_path)
-
-            first_jump = self.start.distance_to(sub_path.start)
-
-            if first_jump < limit:
-                self.print('going sub path, first_jump= %.2f' % first_jump)
-                sub_best_len, sub_best_path = sub_path.best_path(limit - first_jump)
-
-                self.pcount += sub_path.pcount
-                self.rcount += sub_path.rcount
-
-                if first_jump + sub_best_len < limit and sub_best_path:
-                    self.print('path looks like shorter', self.start, sub_best_path)
-                    limit = first_jump + sub_best_len
-                    found_best = copy.copy([self.start] + sub_best_path)
-                else:
-                    self.print('path is not shorter')
+        if limit == 0 and len(poi) >= BOUND_MIN:
+            # good first path rejects most of the tree
+            limit, found_best = heuristic_path(rows, start, poi, finish)
+        elif limit == 0:
+            found_best = (start,) + poi + (finish,)
+            limit = self._path_len(found_best)
+        self.print('Starting with path len:', limit)
+
+        if self._pool and level == 0:
+            return self.__best_path_with_workers(start, poi, finish, limit, found_best)
+
+        perm = array('H', poi)
+        size = len(perm)
+        factorial = [math.factorial(x) for x in range(size + 1)]
+        # no nonlocal in python 2
+        best = [limit, found_best]
+        shared = self._bound if offset is not None else None
+
+        # every poi and finish is entered once, from start or other poi
+        bounds = size >= BOUND_MIN
+        nearest = {x: min([rows[y][x] for y in (start,) + poi if y != x]) for x in poi}
+        finish_nearest = min([rows[x][finish] for x in poi])
+        bit = {x: 1 << indx for indx, x in enumerate(poi)}
+        mst = {}
+
+        # allowed next hops, nearest first, and position of every poi in perm
+        restrict = [None]
+        where = {x: indx for indx, x in enumerate(perm)}
+        if CANDIDATES and size > CANDIDATES:
+            restrict[0] = self._candidates(start, poi)
+
+        def reject_by_bound(k, curr, length, rest, nearest_rest):
+            """Name of the lower bound of path curr->rest->finish which is too long"""
+            if length + nearest_rest + finish_nearest >= best[0]:
+                return 'nearest'
+
+            # curr->rest->finish without first jump is a spanning tree of rest and finish
+            if rest not in mst:
+                mst[rest] = self._matrix.mst_length(perm[k:] + array('H', [finish]))
+            if length + min([rows[curr][x] for x in perm[k:]]) + mst[rest] >= best[0]:
+                return 'mst'
+
+            return None
+
+        def permute(k, curr, length, rest=0, nearest_rest=0):
+            if k == size:
+                self.pcount += 1
+                length += rows[curr][finish]
+                if length < best[0]:
+                    best[0] = length
+                    best[1] = (start,) + tuple(perm) + (finish,)
+                    if shared:
+                        shared.update(offset + length)
+                return
+
+            if restrict[0]:
+                candidates = [where[x] for x in restrict[0][curr] if where[x] >= k]
+                skipped = (size - k - len(candidates)) * factorial[size - k - 1]
+                self.rcount += skipped
+                self.rejected['candidates'] += skipped
             else:
-                # reject all sub path when first jump is too long (minus start, finish, elem)
-                self.rcount += math.factorial(len(self._path) - 3)
-
-            if indx < len(sub_path) - 1:
-                sub_path._swap(0, indx)
-
-        self.print('BP:', limit, found_best)
+                candidates = range(k, size)
+                if bounds:
+                    # nearest first finds short path early, positions are restored after each swap
+                    row = rows[curr]
+                    candidates = sorted(candidates, key=lambda x: row[perm[x]])
+
+            for indx in candidates:
+                perm[k], perm[indx] = perm[indx], perm[k]
+                where[perm[k]], where[perm[indx]] = k, indx
+                jump = length + rows[curr][perm[k]]
+                if jump >= best[0]:
+                    # reject all sub path when jump is too long
+                    self.rcount += factorial[size - k - 1]
+                elif shared and offset + jump >= shared.value:
+                    # other branch has already found shorter path
+                    self.rcount += factorial[size - k - 1]
+                    self.bcount += factorial[size - k - 1]
+                elif bounds and k + 1 < size:
+                    sub_rest = rest & ~bit[perm[k]]
+                    sub_nearest = nearest_rest - nearest[perm[k]]
+                    reason = reject_by_bound(k + 1, perm[k], jump, sub_rest, sub_nearest)
+                    if reason:
+                        self.rcount += factorial[size - k - 1]
+                        self.rejected[reason] += factorial[size - k - 1]
+                    else:
+                        permute(k + 1, perm[k], jump, sub_rest, sub_nearest)
+                else:
+                    permute(k + 1, perm[k], jump)
+                perm[k], perm[indx] = perm[indx], perm[k]
+                where[perm[k]], where[perm[indx]] = k, indx
+
+        permute(0, start, 0, sum(bit.values()), sum(nearest.values()))
+        if restrict[0] and best[1] is None:
+            # no path with nearest hops only, proves nothing
+            restrict[0] = None
+            permute(0, start, 0, sum(bit.values()), sum(nearest.values()))
+        self.print('BP:', best[0], best[1])
+
+        return best[0], best[1]
+
+    def _run_task(self, task, *args):
+        """Run task in the worker, return result and path counters"""
+        self.pcount, self.rcount, self.bcount = 0, 0, 0
+        self.rejected = dict.fromkeys(self.rejected, 0)
+        ret = task(*args)
+        return ret, (self.pcount, self.rcount, self.bcount, self.rejected)
+
+    def _add_counts(self, counts):
+        self.pcount += counts[0]
+        self.rcount += counts[1]
+        self.bcount += counts[2]
+        for key, value in counts[3].items():
+            self.rejected[key] += value
+
+    def _hop_task(self, start, hop, poi, finish):
+        """Best path which starts with start->hop, None if not shorter than shared bound"""
+        jump = self._matrix.rows[start][hop]
+        limit = self._bound.value - jump
+        if limit <= 0:
+            self.rcount += math.factorial(len(poi))
+            self.bcount += math.factorial(len(poi))
+            return None
+
+        found_len, found_best = self.__best_path(hop, poi, finish, limit, offset=jump)
+        if not found_best:
+            return None
+
+        return jump + found_len, (start,) + found_best
+
+    def __best_path_with_workers(self, start, poi, finish, limit, found_best):
+        """Search every first hop in separate worker process"""
+        self._bound.value = limit
+        tasks = [(start, each, poi[:indx] + poi[indx + 1:], finish)
+                 for indx, each in enumerate(poi)]
+
+        for ret, counts in self._pool.map(_hop_worker, tasks, chunksize=1):
+            self._add_counts(counts)
+            if ret and ret[0] < limit:
+                limit, found_best = ret
 
         return limit, found_best
 
-    @staticmethod
-    def __with_threads(p_one, p_two):
-        if len(p_one) >= len(p_two):
-            # spawn separate thread for longest distance
-            # use current thread for short one
-            t_one = _T_Distance(p_one)
-            t_one.start()
+    def _split_task(self, one, two, level, bound=None):
+        """Join best paths of both halves, None if not shorter than bound"""
+        bound = bound or self._bound
+        l_one, path_one = self._best_path(one[0], tuple(one[1:-1]), one[-1], 0, level)
+        if bound.value and l_one >= bound.value:
+            # other split has already found shorter path
+            self.rcount += math.factorial(len(two) - 2)
+            self.bcount += math.factorial(len(two) - 2)
+            return None
 
-            path_two = p_two.best_path()[-1]
+        l_two, path_two = self._best_path(two[0], tuple(two[1:-1]), two[-1],
+                                          bound.value - l_one if bound.value else 0, level)
+        if not path_two:
+            return None
 
-            t_one.join()
-            path_one = t_one.best[-1]
-        else:
-            path_two, path_one = _BaseDistance.__with_threads(p_two, p_one)
+        l = l_one + l_two
+        bound.update(l)
+        return l, path_one + path_two[1:]
 
-        return path_one, path_two
+    def _scaled_order(self, start, poi, finish):
+        """Poi ordered by scaled distance a / (a + b) between start and finish"""
+        rows = self._matrix.lengths
 
-    @staticmethod
-    def join(a, b):
-        assert a is not None
-        assert b is not None
-        assert a[-1] == b[0]
+        def scaled(each):
+            a, b = rows[start][each], rows[finish][each]
+            return a / (a + b)
 
-        return _BaseDistance(a + b[1:])
+        # sort is stable, poi with equal position keep their order
+        return sorted(poi, key=scaled)
 
-    def split(self, position):
-        p_one = _BaseDistance(self._path[:position + 1])
-        p_one.level = self.level + 2
-        p_two = _BaseDistance(self._path[position:])
-        p_two.level = self.level + 2
+    def _split_positions(self, scaled_distance):
+        """Split positions from the middle out, or SPLIT_POINTS most promising"""
+        positions = list(self._left_right_range(len(scaled_distance)))
+        if not SPLIT_POINTS or len(positions) <= SPLIT_POINTS:
+            return positions
 
-        return p_one, p_two
+        rows = self._matrix.rows
 
-    def slice(self, start, finish=-1):
-        raise NotImplementedError
-        sub_path = _BaseDistance(self._path[start:finish])
-        sub_path.level = self.level + 2
+        def estimate(indx):
+            one, two = scaled_distance[:indx + 1], scaled_distance[indx:]
+            return (heuristic_path(rows, one[0], one[1:-1], one[-1])[0] +
+                    heuristic_path(rows, two[0], two[1:-1], two[-1])[0])
 
-        return sub_path
+        return sorted(positions, key=estimate)[:SPLIT_POINTS]
 
     def _left_right_range(self, l):
-        middle = l/2
+        middle = l // 2
         yield middle
         i = 1
         val = middle
@@ -322,47 +749,52 @@ class _BaseDistance(MemCache):
                 yield val
             i += 1
 
-    def _seq_range(self, l):
-        return range(2, l - 2)
-
-    def __best_path_with_split(self):
-        ret = {}
+    def __best_path_with_split(self, start, poi, finish, level):
+        scaled_distance = [start] + self._scaled_order(start, poi, finish) + [finish]
+        positions = self._split_positions(scaled_distance)
 
-        for each in self.poi:
-            a, b = self.start.distance_to(each), self.finish.distance_to(each)
-            # this will remove duplicates!!!
-            ret[a / (a + b)] = each
+        if self._pool and level == 0:
+            return self.__best_path_with_workers_split(scaled_distance, positions, level)
 
-        scaled_distance = _BaseDistance([self.start] +
-                                        [ret[k] for k in sorted(ret.keys())] +
-                                        [self.finish])
         best_l = 0
         best_best = None
-        for indx in self._seq_range(len(scaled_distance)):
+        bound = _Bound()
+        for indx in positions:
             _start = time.time()
-            p_one, p_two = scaled_distance.split(position=indx)
-            if self.level == 0:
-                ratio = '%d/%d' % (len(p_one), len(p_two))
+            one, two = scaled_distance[:indx + 1], scaled_distance[indx:]
+            if level == 0:
+                ratio = '%d/%d' % (len(one), len(two))
             else:
                 ratio = None
-            assert len(p_one) > 2 and len(p_two) > 2, ratio
+            assert len(one) > 2 and len(two) > 2, ratio
+
+            ret = self._split_task(one, two, level + 2, bound)
 
-            if THREADS and min([len(p_one), len(p_two)]) > THREADS:
-                test_path = _BaseDistance.join(*self.__with_threads(p_one, p_two))
-            else:
-                test_path = _BaseDistance.join(p_one.best_path()[-1],
-                                               p_two.best_path()[-1])
-            
             _elapsed = time.time() - _start
             if ratio and _elapsed > 1:
                 print(ratio, ('Elapsed: %s' % str(datetime.timedelta(seconds=_elapsed)).split('.')[0]))
 
-            l = test_path.len_path_asis
-            if best_l == 0 or l < best_l:
-                best_l = l
-                best_best = copy.copy(test_path.path)
+            if ret and (best_l == 0 or ret[0] < best_l):
+                best_l, best_best = ret
                 if ratio:
-                    print(ratio, l)
+                    print(ratio, best_l)
+
+        return best_l, best_best
+
+    def __best_path_with_workers_split(self, scaled_distance, positions, level):
+        """Evaluate every split position in separate worker process"""
+        self._bound.value = 0
+        tasks = [(scaled_distance[:indx + 1], scaled_distance[indx:], level + 2)
+                 for indx in positions]
+
+        best_l = 0
+        best_best = None
+        results = self._pool.map(_split_worker, tasks, chunksize=1)
+        for (one, two, _level), (ret, counts) in zip(tasks, results):
+            self._add_counts(counts)
+            if ret and (best_l == 0 or ret[0] < best_l):
+                best_l, best_best = ret
+                print('%d/%d' % (len(one), len(two)), best_l)
 
         return best_l, best_best
 
@@ -382,34 +814,18 @@ class _BaseDistance(MemCache):
 
 
 class Distance(_BaseDistance):
-    def __init__(self, dist, name=None, skip_minor=False):
+    def __init__(self, dist, name=None, skip_minor=False, seed=None, cost=None, matrix=None):
         data = []
 
         if isinstance(dist, list):
             data = copy.copy(dist)
-        elif isinstance(dist, str):
-            for each in dist.splitlines():
-                each = each.decode('utf-8').strip()
-                if each and each[0] != '#':
-                    each = each.replace('–', '-')
-                    if '- GalMap Ref:' in each:
-                        each = each.replace('- GalMap Ref:', '/')
-                        arr = [x.strip() for x in each.split('/', 2)]
-                        arr.reverse()
-                    else:
-                        arr = [x.strip() for x in each.split('/', 2)]
-
-                    # add as mSystem when name or alias starts or ends with _
-                    s = System
-                    for indx, elem in enumerate(arr):
-                        if elem[0] == '_' or elem[-1] == '_':
-                            s = mSystem
-                            arr[indx] = elem.strip('_ ')
-
-                    if len(arr) == 1 or arr[0] == arr[1]:
-                        data.append(s(name=arr[0]))
-                    else:
-                        data.append(s(name=arr[0], alias=arr[1]))
+            # unknown systems are fetched all together
+            System.load_all([x for x in data if isinstance(x, System)])
+        elif isinstance(dist, basestring):
+            data = routefile.load(dist.splitlines())
+        elif hasattr(dist, '__iter__'):
+            # file or other stream of lines
+            data = routefile.load(dist)
         else:
             raise ValueError('Unsupported type')
 
@@ -453,18 +869,86 @@ class Distance(_BaseDistance):
             #               seq mc28:   1:07
             #               seq mc32:   1:06
 
-        super(Distance, self).__init__(data, name)
-
-    def best_path(self, limit=0):
-        self.shuffle_poi()
-        return super(Distance, self).best_path(limit)
+        super(Distance, self).__init__(data, name, matrix=matrix, cost=cost)
+        self.seed = seed
+        # minor poi left out by best_path_with_minor
+        self.dropped = []
 
-    def shuffle_poi(self):
+    def best_path(self, limit=0, method=None):
+        if self.seed is None:
+            self.sort_poi()
+        else:
+            self.shuffle_poi(self.seed)
+        return super(Distance, self).best_path(limit, method)
+
+    def _sub_distance(self, systems):
+        return Distance(systems, self.name, seed=self.seed, matrix=self._matrix)
+
+    def best_path_with_minor(self, budget=None, detour=None, method=None):
+        """
+        Path over every major poi and the minor poi worth visiting
+
+        Minor poi are inserted into the best path of major poi one at a time,
+        the cheapest detour first, while the detour of one poi is not over
+        detour and all of them together are not over budget (cost units,
+        None is no limit). Selected poi are ordered by best_path again and
+        the shorter path may leave room for more of them.
+        """
+        rows = self._matrix.rows
+        minor = [x for x in self.poi if isinstance(x, mSystem)]
+        path = [self.start] + [x for x in self.poi if not isinstance(x, mSystem)] + [self.finish]
+        base_len, path = self._sub_distance(path).best_path(method=method)
+        path = list(path)
+        found_len = base_len
+
+        while minor:
+            inserted = False
+            while minor:
+                order = [self._matrix.index(x) for x in path]
+                extra, n, at = min([(rows[a][k] + rows[k][b] - rows[a][b], n, indx + 1)
+                                    for n, k in enumerate([self._matrix.index(x) for x in minor])
+                                    for indx, (a, b) in enumerate(zip(order, order[1:]))])
+                if detour is not None and extra > detour + EPSILON:
+                    break
+                if budget is not None and found_len + extra - base_len > budget + EPSILON:
+                    break
+                path.insert(at, minor.pop(n))
+                found_len += extra
+                inserted = True
+
+            if not inserted:
+                break
+
+            length, best = self._sub_distance(path).best_path(method=method)
+            if length > found_len - EPSILON:
+                break
+            found_len, path = length, list(best)
+
+        self.dropped = minor
+        self.found_len = found_len
+        return found_len, path
+
+    def shuffle_poi(self, seed=None):
         if len(self) > 3:
             tpath = self.poi
-            random.shuffle(tpath)
+            random.Random(seed).shuffle(tpath)
             self._path = [self.start] + tpath + [self.finish]
 
+    def sort_poi(self):
+        """Order poi by projection on the line from start to finish"""
+        if len(self) > 3:
+            a, b = self.start, self.finish
+            ab = self._matrix.distance(a, b) ** 2
+
+            def projection(each):
+                # law of cosines, equal poi keep their order as sort is stable
+                if not ab:
+                    return 0
+                return (self._matrix.distance(a, each) ** 2 + ab -
+                        self._matrix.distance(b, each) ** 2) / (2 * ab)
+
+            self._path = [self.start] + sorted(self.poi, key=projection) + [self.finish]
+
 
 class MultiDistance(object):
     def __init__(self, *args):
@@ -480,8 +964,8 @@ class MultiDistance(object):
         return self.distances[0].start.distance_to(self.distances[-1].finish)
 
     @staticmethod
-    def print_path(best_path):
-        Distance.print_path(best_path)
+    def print_path(best_path, cost=None):
+        Distance.print_path(best_path, cost)
 
     def best_path_with_split(self):
         best_len = 0
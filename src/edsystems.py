@@ -1,22 +1,14 @@
 from __future__ import print_function, unicode_literals
 
-import json
 import math
-import time
-import urllib
-from collections import OrderedDict
 
-import requests
-
-from src.filecache import FileCache
-
-API_CALL = 'https://www.edsm.net/api-v1/system'
-# be polite, delay in seconds
-DELAY = 3
+from src.resolver import default_resolver
 
 
 class Coords(object):
     """XYZ coordinates"""
+    __slots__ = ('x', 'y', 'z')
+
     def __init__(self, x, y, z):
         self.x = x
         self.y = y
@@ -33,47 +25,61 @@ class Coords(object):
         return 'Coords(x={x}, y={y}, z={z})'.format(x=self.x, y=self.y, z=self.z)
 
 
-class System(Coords, FileCache):
-    """System we travel"""
+class System(Coords):
+    """
+    System we travel, immutable
+
+    When coordinates are not given they are loaded by name on first use,
+    or for many systems at once by System.load_all.
+    """
+    __slots__ = ('_name', '_alias')
+
     def __init__(self, name, alias=None, coords=None):
-        self._name = name
-        self._alias = alias or name
-
-        if coords is None:
-            coords = self._load_coords()
-        super(System, self).__init__(coords.x, coords.y, coords.z)
-        self.__known_distances = {}
-
-    def _load_coords(self):
-        self.fname = self._name.encode('utf-8')
-
-        with self.open() as f:
-            if f:
-                data = json.load(f)
-            else:
-                print('Connecting to EDSM for [%s]' % self._name)
-                params = OrderedDict([('systemName', self._name), ('showCoordinates', 1)])
-                r = requests.get(API_CALL, params=urllib.urlencode(params))
-                if r.status_code == 200:
-                    self.save(r.text)
-                    data = json.loads(r.text)
-                    time.sleep(DELAY)
-                else:
-                    print('ERROR: status %s is not 200' % r.status_code)
-                    raise RuntimeError
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_alias', alias or name)
+        if coords is not None:
+            self._set_coords(coords)
+
+    def _set_coords(self, coords):
+        for each in Coords.__slots__:
+            object.__setattr__(self, each, coords[each] if isinstance(coords, dict) else getattr(coords, each))
 
+    @property
+    def loaded(self):
+        """Are coordinates known"""
         try:
-            if self._name.lower() != data.get('name', '').lower() or 'coords' not in data:
-                raise RuntimeError('Bad data')
+            object.__getattribute__(self, 'x')
         except AttributeError:
-            print(data)
-            self.remove()
-            raise
-
-        return Coords(**data['coords'])
+            return False
+        return True
+
+    @staticmethod
+    def load_all(systems):
+        """Load coordinates of all systems which have none with one resolver call"""
+        todo = [x for x in systems if not x.loaded]
+        if todo:
+            coords = default_resolver().resolve([x.name for x in todo])
+            for each in todo:
+                each._set_coords(coords[each.name])
+
+    def __getattr__(self, attr):
+        # called when slot of coordinates is not set yet
+        if attr in Coords.__slots__:
+            System.load_all([self])
+            return object.__getattribute__(self, attr)
+        raise AttributeError(attr)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('System is immutable')
+
+    def __reduce__(self):
+        coords = Coords(self.x, self.y, self.z) if self.loaded else None
+        return self.__class__, (self._name, self._alias, coords)
 
     def __repr__(self):
-        return 'System(name={name}, {coords})'.format(name=self._name, coords=super(System, self).__repr__())
+        # repr of system without coordinates must not connect to EDSM
+        coords = super(System, self).__repr__() if self.loaded else 'coords=?'
+        return 'System(name={name}, {coords})'.format(name=self._name, coords=coords)
 
     @property
     def name(self):
@@ -85,31 +91,22 @@ class System(Coords, FileCache):
         """Get system alias"""
         return self._alias
 
-    def store_distance_to(self, other, value):
-        """Cache distance to other system"""
-        self.__known_distances[other.name] = value
-
-    def known_distance_to(self, other):
-        """Retrieve distance to other system from cache"""
-        return self.__known_distances.get(other.name, None)
-
-    def _distance_to(self, other):
-        ret = super(System, self).distance_to(other)
-        self.store_distance_to(other, ret)
-        # this will double memory footprint
-        other.store_distance_to(self, ret)
-        return ret
-
-    def distance_to(self, other):
-        """Get distance to other system"""
-        return self.known_distance_to(other) or other.known_distance_to(self) or self._distance_to(other)
-
     def __eq__(self, other):
-        assert isinstance(other, System)
+        if not isinstance(other, System):
+            return NotImplemented
         return self.name == other.name
 
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    def __hash__(self):
+        return hash(self._name)
+
 
 class mSystem(System):
+    __slots__ = ()
+
     @property
     def alias(self):
         """Get system alias"""
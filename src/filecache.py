@@ -1,9 +1,16 @@
 from __future__ import print_function
 
+import atexit
 import datetime
 import hashlib
+import heapq
 import os
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
 from contextlib import contextmanager
+from StringIO import StringIO
 
 
 class NoCache(object):
@@ -23,37 +30,110 @@ class NoCache(object):
 
 
 class MemCache(NoCache):
+    """
+    Bounded in memory cache shared by all instances
+
+    When full, entry with the lowest priority is evicted (GreedyDual-Size):
+    priority is time spent to compute the entry per byte plus priority of
+    the last evicted entry, so expensive results survive and entries not
+    read for long time age out.
+    """
+    # limits, None is unlimited
+    MAX_ENTRIES = 200000
+    MAX_BYTES = 256 * 1024 * 1024
+    # bytes of bookkeeping per entry besides key and data: slots of six
+    # dicts, counters and heap items, measured on 64 bit python 2.7
+    ENTRY_OVERHEAD = 700
+
     cache = {}
     hit = {}
     miss = {}
     time_spent = {}
+    priority = {}
+    size = {}
     reads = 0
     hits = 0
     misses = 0
-
-    def __init__(self, cache_name):
+    evictions = 0
+    total_size = 0
+    # priority of the last evicted entry
+    _inflation = 0.0
+    # (priority, key), stale when priority of the key has changed. Rebuilt
+    # when it grows over twice the number of entries
+    _heap = []
+
+    def __init__(self, cache_name, key=None):
         super(MemCache, self).__init__(cache_name)
-        if self._cache_name:
+        if key is not None:
+            self._key = key
+        elif self._cache_name:
             self._key = self.gen_hash(self._cache_name)
 
-            if self._key not in MemCache.cache:
-                MemCache.cache[self._key] = None
-                MemCache.hit[self._key] = 0
-                MemCache.miss[self._key] = 0
-                MemCache.time_spent[self._key] = 0
-
     @staticmethod
     def gen_hash(s):
         return hashlib.sha256(s).hexdigest()
 
-    def save(self, data, time_spent=None):
+    @staticmethod
+    def _sizeof(data):
+        if isinstance(data, (tuple, list)):
+            return sys.getsizeof(data) + sum([MemCache._sizeof(x) for x in data])
+        return sys.getsizeof(data)
+
+    @staticmethod
+    def _touch(key):
+        priority = MemCache._inflation + float(MemCache.time_spent[key]) / MemCache.size[key]
+        MemCache.priority[key] = priority
+        heapq.heappush(MemCache._heap, (priority, key))
+        if len(MemCache._heap) > 2 * len(MemCache.cache):
+            # every read adds an item, drop stale ones
+            MemCache._heap[:] = [(v, k) for k, v in MemCache.priority.items()]
+            heapq.heapify(MemCache._heap)
+
+    @staticmethod
+    def _drop(key):
+        MemCache.total_size -= MemCache.size[key]
+        # entry in the heap gets stale
+        for each in (MemCache.cache, MemCache.hit, MemCache.miss,
+                     MemCache.time_spent, MemCache.priority, MemCache.size):
+            del each[key]
+
+    @staticmethod
+    def _evict():
+        while MemCache._heap:
+            priority, key = heapq.heappop(MemCache._heap)
+            if MemCache.priority.get(key) == priority:
+                MemCache._inflation = priority
+                MemCache._drop(key)
+                MemCache.evictions += 1
+                return
+
+    @staticmethod
+    def _full():
+        return ((MemCache.MAX_ENTRIES is not None and len(MemCache.cache) > MemCache.MAX_ENTRIES) or
+                (MemCache.MAX_BYTES is not None and MemCache.total_size > MemCache.MAX_BYTES))
+
+    def save(self, data, time_spent=None, replace=False):
         if self._key:
-            if MemCache.cache.get(self._key, None):
+            if replace and self._key in MemCache.cache:
+                MemCache._drop(self._key)
+            old = MemCache.cache.get(self._key, None)
+            if old is not None:
+                # same result computed again, e.g. by other branch
+                if old == data:
+                    return
                 raise ValueError('Duplicate value %s for key %s' % (self._cache_name, self._key))
-            else:
-                MemCache.cache[self._key] = data
-            if time_spent:
-                MemCache.time_spent[self._key] = time_spent
+            MemCache.cache[self._key] = data
+            MemCache.hit[self._key] = 0
+            # it was computed once because of the miss
+            MemCache.miss[self._key] = 1
+            MemCache.time_spent[self._key] = time_spent or 0
+            MemCache.size[self._key] = (MemCache._sizeof(data) + MemCache._sizeof(self._key) +
+                                        MemCache.ENTRY_OVERHEAD)
+            MemCache.total_size += MemCache.size[self._key]
+            MemCache._touch(self._key)
+
+            while MemCache._full():
+                MemCache._evict()
 
     def read(self):
         ret = None
@@ -64,9 +144,9 @@ class MemCache(NoCache):
             if ret:
                 MemCache.hits += 1
                 MemCache.hit[self._key] += 1
+                MemCache._touch(self._key)
             else:
                 MemCache.misses += 1
-                MemCache.miss[self._key] += 1
 
         return ret
 
@@ -88,6 +168,8 @@ class MemCache(NoCache):
         miss_count = max(MemCache.miss.values())
         print('miss:  size=%4d, max=%4d, total=%d' % (len(MemCache.miss),
                                                       miss_count, MemCache.misses))
+        print('evicted: %d, memory used %.1f MB' % (MemCache.evictions,
+                                                    MemCache.total_size / 1024.0 / 1024))
 
         step = max(hit_count / 10, 1)
         start = 0
@@ -133,59 +215,230 @@ class MemCache(NoCache):
 
 
 class FileCache(MemCache):
-    """File Cache of the objects or data"""
+    """
+    Persistent cache of the objects or data in single SQLite file
+
+    Entries live in namespaces (coordinates, paths) keyed by hash of
+    the name. Writes are kept in memory and stored BATCH at a time in one
+    transaction, call flush() to store them now.
+
+    Every entry has version of its namespace, entries of other versions
+    are not read and can be removed by prune().
+
+    Several processes can share the file: every write is one transaction
+    which takes the write lock first and waits up to BUSY_TIMEOUT for it.
+    """
+    # version of the table layout
+    SCHEMA_VERSION = 1
 
-    # cache directory
+    # cache file
+    CACHE_FILE = os.path.join(os.path.dirname(__file__), '.edpathcache.sqlite')
+    # old one file per entry cache, see import_tree
     CACHE_DIR = os.path.join(os.path.dirname(__file__), '.edpathcache')
-    # number of chracters used to build cache tree
-    _DIR_CHAR = 2
+    # number of entries written in one transaction
+    BATCH = 50
+    # seconds to wait for other process to finish its write
+    BUSY_TIMEOUT = 60
+    # SQLite journal mode, None keeps the default. WAL lets readers work
+    # during writes, but it needs all processes on one host (no NFS)
+    JOURNAL_MODE = None
+    # namespace and version of the entries, subclasses override it
+    NAMESPACE = 'data'
+    VERSION = 0
+
+    # (namespace, key): (data, version, created) waiting for flush
+    _pending = OrderedDict()
+    _db = None
+    # connection can not be shared with forked processes
+    _db_pid = None
 
-    if not os.path.exists(CACHE_DIR):
-        os.mkdir(CACHE_DIR)
+    @staticmethod
+    def _connect():
+        if FileCache._db is None or FileCache._db_pid != os.getpid():
+            # transactions are started by _transaction
+            FileCache._db = sqlite3.connect(FileCache.CACHE_FILE, timeout=FileCache.BUSY_TIMEOUT,
+                                            isolation_level=None)
+            FileCache._db_pid = os.getpid()
+            if FileCache.JOURNAL_MODE:
+                FileCache._db.execute('PRAGMA journal_mode = %s' % FileCache.JOURNAL_MODE)
+            FileCache._upgrade(FileCache._db)
+
+        return FileCache._db
 
-    def __init__(self, cache_name):
-        super(FileCache, self).__init__(cache_name=cache_name)
-        if cache_name:
-            self.__fname = FileCache.set_fname(cache_name)
-        else:
-            self.__fname = None
+    @staticmethod
+    @contextmanager
+    def _transaction():
+        """Write transaction, holds the write lock from the start"""
+        db = FileCache._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
 
     @staticmethod
-    def set_fname(utf8_encoded_name):
-        if utf8_encoded_name:
-            _hash = MemCache.gen_hash(utf8_encoded_name)
-            base_dir = os.path.join(FileCache.CACHE_DIR, _hash[:FileCache._DIR_CHAR])
-            if not os.path.exists(base_dir):
-                os.mkdir(base_dir)
+    def _upgrade(db):
+        if db.execute('PRAGMA user_version').fetchone()[0] == FileCache.SCHEMA_VERSION:
+            return
 
-            return os.path.join(base_dir, _hash[FileCache._DIR_CHAR:])
-        else:
-            return None
+        # db is set already, so _transaction does not come here again
+        with FileCache._transaction():
+            # other process may have upgraded it meanwhile
+            schema = db.execute('PRAGMA user_version').fetchone()[0]
+            if schema > FileCache.SCHEMA_VERSION:
+                raise RuntimeError('Cache %s is newer than this code' % FileCache.CACHE_FILE)
+
+            db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                       'namespace TEXT NOT NULL, '
+                       'key TEXT NOT NULL, '
+                       'data BLOB NOT NULL, '
+                       'PRIMARY KEY (namespace, key)) WITHOUT ROWID')
+            # 0 -> 1: version and creation time of the entries
+            columns = [x[1] for x in db.execute('PRAGMA table_info(cache)')]
+            if 'version' not in columns:
+                db.execute('ALTER TABLE cache ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+                db.execute('ALTER TABLE cache ADD COLUMN created REAL NOT NULL DEFAULT 0')
+            db.execute('CREATE INDEX IF NOT EXISTS cache_created ON cache (namespace, created)')
+            db.execute('PRAGMA user_version = %d' % FileCache.SCHEMA_VERSION)
+
+    @staticmethod
+    def close():
+        FileCache.flush()
+        if FileCache._db is not None and FileCache._db_pid == os.getpid():
+            FileCache._db.close()
+        FileCache._db = None
+
+    @staticmethod
+    def flush():
+        if FileCache._pending:
+            with FileCache._transaction() as db:
+                db.executemany('INSERT OR REPLACE INTO cache (namespace, key, data, version, created) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               [k + v for k, v in FileCache._pending.items()])
+            FileCache._pending.clear()
+
+    @staticmethod
+    def clear(namespace):
+        """Remove all entries of the namespace"""
+        for each in [k for k in FileCache._pending if k[0] == namespace]:
+            del FileCache._pending[each]
+        with FileCache._transaction() as db:
+            db.execute('DELETE FROM cache WHERE namespace = ?', (namespace,))
+
+    @staticmethod
+    def stats(versions=None):
+        """
+        Entries, bytes, time of the oldest entry and number of stale entries
+        for every namespace. versions maps namespace to its current version.
+        """
+        FileCache.flush()
+        versions = versions or {}
+        ret = {}
+        for namespace, version, entries, size, oldest in FileCache._connect().execute(
+                'SELECT namespace, version, COUNT(*), SUM(LENGTH(data)), MIN(created) '
+                'FROM cache GROUP BY namespace, version'):
+            stat = ret.setdefault(namespace, {'entries': 0, 'bytes': 0, 'oldest': oldest, 'stale': 0})
+            stat['entries'] += entries
+            stat['bytes'] += size
+            stat['oldest'] = min(stat['oldest'], oldest)
+            if versions.get(namespace, version) != version:
+                stat['stale'] += entries
+
+        return ret
+
+    @staticmethod
+    def prune(namespace=None, versions=None, max_age=None, max_bytes=None):
+        """
+        Remove entries of other than current versions, then entries of the
+        namespace older than max_age seconds, then oldest entries of the
+        namespace while it takes more than max_bytes. Returns number of
+        removed entries.
+        """
+        FileCache.flush()
+        db = FileCache._connect()
+        before = db.total_changes
+        with FileCache._transaction():
+            for each, version in (versions or {}).items():
+                db.execute('DELETE FROM cache WHERE namespace = ? AND version != ?', (each, version))
+            if namespace and max_age is not None:
+                db.execute('DELETE FROM cache WHERE namespace = ? AND created < ?',
+                           (namespace, time.time() - max_age))
+            if namespace and max_bytes is not None:
+                size = 0
+                old = []
+                for key, length in db.execute('SELECT key, LENGTH(data) FROM cache WHERE namespace = ? '
+                                              'ORDER BY created DESC', (namespace,)):
+                    size += length
+                    if size > max_bytes:
+                        old.append((namespace, key))
+                db.executemany('DELETE FROM cache WHERE namespace = ? AND key = ?', old)
+
+        return db.total_changes - before
+
+    @staticmethod
+    def compact():
+        """Give space of removed entries back to the file system"""
+        FileCache.flush()
+        FileCache._connect().execute('VACUUM')
+
+    @staticmethod
+    def import_tree(cache_dir=None):
+        """Move entries of old one file per entry cache into the cache file"""
+        cache_dir = cache_dir or FileCache.CACHE_DIR
+        count = 0
+        for base_dir, _, files in os.walk(cache_dir):
+            for each in files:
+                fname = os.path.join(base_dir, each)
+                with open(fname) as f:
+                    data = f.read()
+                # sub paths are the only entries with found_len
+                namespace = 'paths' if '"found_len"' in data else 'coords'
+                key = os.path.basename(base_dir) + each
+                # format is the same, so these are entries of version 0
+                FileCache._pending[(namespace, key)] = (data, 0, os.path.getmtime(fname))
+                count += 1
+                if len(FileCache._pending) >= FileCache.BATCH:
+                    FileCache.flush()
+        FileCache.flush()
+
+        return count
 
     @property
-    def fname(self):
-        return self.__fname
+    def key(self):
+        return self._key
 
-    @fname.setter
-    def fname(self, value):
-        self.__fname = FileCache.set_fname(value)
+    @key.setter
+    def key(self, value):
+        self._key = MemCache.gen_hash(value) if value else None
 
     def save(self, data):
-        if self.fname:
-            with open(self.fname, 'w') as f:
-                f.write(data)
-
-        # else:
-            # print('WARNING data was not saved because fname is Not set')
+        if self.key:
+            FileCache._pending[(self.NAMESPACE, self.key)] = (data, self.VERSION, time.time())
+            if len(FileCache._pending) >= FileCache.BATCH:
+                FileCache.flush()
 
     @contextmanager
     def open(self):
-        if self.fname and os.path.exists(self.fname):
-            # print('Loading from file')
-            with open(self.fname) as f:
-                yield f
-        else:
-            yield None
+        data = None
+        if self.key:
+            row = FileCache._pending.get((self.NAMESPACE, self.key))
+            if row is None:
+                row = FileCache._connect().execute(
+                    'SELECT data, version FROM cache WHERE namespace = ? AND key = ?',
+                    (self.NAMESPACE, self.key)).fetchone()
+            # entry of other version is stale
+            if row and row[1] == self.VERSION:
+                data = row[0]
+
+        yield StringIO(data) if data is not None else None
 
     def remove(self):
-        os.remove(self.fname)
+        FileCache._pending.pop((self.NAMESPACE, self.key), None)
+        with FileCache._transaction() as db:
+            db.execute('DELETE FROM cache WHERE namespace = ? AND key = ?',
+                       (self.NAMESPACE, self.key))
+
+
+atexit.register(FileCache.flush)
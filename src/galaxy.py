@@ -0,0 +1,164 @@
+"""
+Offline coordinates of the galaxy from EDSM nightly dump
+
+import_dump streams systemsWithCoordinates.json (optionally .gz) into one
+index file, memory used is bounded by CHUNK systems: sorted chunks are
+written to temporary files and merged. GalaxyIndex maps the file and
+finds a system by binary search over names.
+
+File layout: header, records sorted by lower case utf-8 name, names.
+Record is offset and length of the name, x, y, z as float32 (coordinates
+are multiples of 1/32 ly, float32 keeps them exact).
+"""
+from __future__ import print_function, unicode_literals
+
+import gzip
+import heapq
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+# index file used by the resolver when it exists
+GALAXY_FILE = os.path.join(os.path.dirname(__file__), '.edgalaxy.idx')
+# systems sorted in memory at once during import
+CHUNK = 1000000
+
+_MAGIC = b'EDGI'
+_VERSION = 1
+# magic, version, number of records, offset of names
+_HEADER = struct.Struct(str('<4sIQQ'))
+# offset and length of the name, x, y, z
+_RECORD = struct.Struct(str('<QHfff'))
+# length of the name, position in the dump, x, y, z in the chunk files, name follows
+_CHUNK_RECORD = struct.Struct(str('<HQfff'))
+
+
+def _key(name):
+    return name.lower().encode('utf-8')
+
+
+def _read_dump(fname):
+    """Name and coordinates of every system in the dump, one object per line"""
+    opener = gzip.open if fname.endswith('.gz') else open
+    with opener(fname, 'rb') as f:
+        for line in f:
+            line = line.strip().rstrip(b',')
+            if not line.startswith(b'{'):
+                # [ and ] of the list
+                continue
+            data = json.loads(line)
+            coords = data.get('coords')
+            if coords:
+                yield data['name'], coords['x'], coords['y'], coords['z']
+
+
+def _write_chunk(chunk, tmp_dir):
+    chunk.sort()
+    fd, fname = tempfile.mkstemp(dir=tmp_dir)
+    with os.fdopen(fd, 'wb') as f:
+        for key, seq, x, y, z in chunk:
+            f.write(_CHUNK_RECORD.pack(len(key), seq, x, y, z))
+            f.write(key)
+
+    return fname
+
+
+def _read_chunk(fname):
+    with open(fname, 'rb') as f:
+        while True:
+            head = f.read(_CHUNK_RECORD.size)
+            if not head:
+                return
+            length, seq, x, y, z = _CHUNK_RECORD.unpack(head)
+            yield (f.read(length), seq, x, y, z)
+
+
+def import_dump(dump, fname=GALAXY_FILE, chunk_size=CHUNK):
+    """Build index file from EDSM dump, returns number of systems"""
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(fname)))
+    try:
+        chunks = []
+        chunk = []
+        for seq, (name, x, y, z) in enumerate(_read_dump(dump)):
+            # same names are ordered as in the dump
+            chunk.append((_key(name), seq, x, y, z))
+            if len(chunk) >= chunk_size:
+                chunks.append(_write_chunk(chunk, tmp_dir))
+                chunk = []
+        if chunk:
+            chunks.append(_write_chunk(chunk, tmp_dir))
+        del chunk
+
+        count = 0
+        offset = 0
+        last = None
+        names_fname = os.path.join(tmp_dir, 'names')
+        index_fname = os.path.join(tmp_dir, 'index')
+        with open(index_fname, 'wb') as index, open(names_fname, 'wb') as names:
+            index.write(_HEADER.pack(_MAGIC, _VERSION, 0, 0))
+            for key, _seq, x, y, z in heapq.merge(*[_read_chunk(x) for x in chunks]):
+                if key == last:
+                    # same system twice, first one in the dump wins
+                    continue
+                last = key
+                index.write(_RECORD.pack(offset, len(key), x, y, z))
+                names.write(key)
+                offset += len(key)
+                count += 1
+
+            names_offset = index.tell()
+            with open(names_fname, 'rb') as names_in:
+                names.flush()
+                shutil.copyfileobj(names_in, index)
+            index.seek(0)
+            index.write(_HEADER.pack(_MAGIC, _VERSION, count, names_offset))
+
+        # replace old index at once
+        os.rename(index_fname, fname)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return count
+
+
+class GalaxyIndex(object):
+    """Read only memory mapped index built by import_dump"""
+    def __init__(self, fname=GALAXY_FILE):
+        with open(fname, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count, self._names = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('%s is not a galaxy index of version %d' % (fname, _VERSION))
+
+    def __len__(self):
+        return self._count
+
+    def _record(self, indx):
+        return _RECORD.unpack_from(self._map, _HEADER.size + indx * _RECORD.size)
+
+    def _name(self, record):
+        start = self._names + record[0]
+        return self._map[start:start + record[1]]
+
+    def find(self, name):
+        """Coordinates {'x':, 'y':, 'z':} of the system, None if unknown"""
+        key = _key(name)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(self._record(middle)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count:
+            record = self._record(low)
+            if self._name(record) == key:
+                return dict(zip('xyz', record[2:]))
+
+        return None
+
+    def close(self):
+        self._map.close()
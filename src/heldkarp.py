@@ -0,0 +1,67 @@
+"""
+Exact open path solver: Held-Karp dynamic programming over POI subsets
+
+Start and finish are fixed, every POI is visited exactly once.
+Memory is O(2^n * n), so keep number of POI under HELD_KARP_MAX.
+"""
+from __future__ import print_function
+
+import numpy
+
+# max number of poi, 20 poi takes ~200MB
+HELD_KARP_MAX = 20
+
+
+def held_karp(matrix):
+    """
+    Find shortest open path over square distance matrix.
+
+    Index 0 is the start, index -1 is the finish, everything in between is poi.
+    Returns path length and order of poi indices (start and finish excluded).
+    """
+    dist = numpy.asarray(matrix, dtype=numpy.float64)
+    size = len(dist) - 2
+    if size < 0:
+        raise ValueError('distance must be two or more poi')
+    if size > HELD_KARP_MAX:
+        raise ValueError('too many poi for exact solver: %d > %d' % (size, HELD_KARP_MAX))
+    if size == 0:
+        return float(dist[0, -1]), []
+
+    poi = dist[1:-1, 1:-1]
+    full = (1 << size) - 1
+
+    # dp[mask, j]: shortest path from start over poi in mask ending at poi j
+    dp = numpy.full((full + 1, size), numpy.inf)
+    parent = numpy.full((full + 1, size), -1, dtype=numpy.int8)
+    for j in range(size):
+        dp[1 << j, j] = dist[0, j + 1]
+
+    masks = numpy.arange(full + 1)
+    popcount = numpy.zeros(full + 1, dtype=numpy.int8)
+    for j in range(size):
+        popcount += (masks >> j) & 1
+
+    # subsets of the same size depend only on smaller ones
+    for count in range(2, size + 1):
+        layer = masks[popcount == count]
+        for j in range(size):
+            with_j = layer[(layer >> j) & 1 == 1]
+            # dp of poi not in mask is inf, so no need to filter previous poi
+            cand = dp[with_j ^ (1 << j)] + poi[:, j]
+            best = cand.argmin(axis=1)
+            dp[with_j, j] = cand[numpy.arange(len(with_j)), best]
+            parent[with_j, j] = best
+
+    total = dp[full] + dist[1:-1, -1]
+    last = int(total.argmin())
+    found_len = float(total[last])
+
+    order = []
+    mask = full
+    while last >= 0:
+        order.append(last + 1)
+        mask, last = mask ^ (1 << last), int(parent[mask, last])
+    order.reverse()
+
+    return found_len, order
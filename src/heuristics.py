@@ -0,0 +1,103 @@
+"""
+Fast heuristic path: nearest neighbour construction and local improvement
+
+Paths are lists of positions in the distance matrix rows,
+first and last position (start and finish) never move.
+"""
+from __future__ import print_function
+
+# ignore improvements smaller than this to avoid looping on rounding errors
+EPSILON = 1e-9
+# longest segment moved by or-opt
+OR_OPT_SEGMENT = 3
+
+
+def path_length(rows, order):
+    """Length of the path in given order"""
+    return sum([rows[order[i]][order[i + 1]] for i in range(len(order) - 1)])
+
+
+def nearest_neighbour(rows, start, poi, finish):
+    """Path which always jumps to the nearest not visited poi"""
+    order = [start]
+    rest = list(poi)
+    while rest:
+        row = rows[order[-1]]
+        nearest = min(range(len(rest)), key=lambda x: row[rest[x]])
+        order.append(rest.pop(nearest))
+    order.append(finish)
+
+    return order
+
+
+def two_opt(rows, order):
+    """Reverse parts of the path while it gets shorter, return True if improved"""
+    improved = False
+    size = len(order)
+    found = True
+    while found:
+        found = False
+        for i in range(1, size - 2):
+            a, b = order[i - 1], order[i]
+            row_a, row_b = rows[a], rows[b]
+            removed = row_a[b]
+            for j in range(i + 1, size - 1):
+                c, d = order[j], order[j + 1]
+                if row_a[c] + row_b[d] - removed - rows[c][d] < -EPSILON:
+                    order[i:j + 1] = order[j:i - 1:-1]
+                    found = improved = True
+                    break
+            if found:
+                break
+
+    return improved
+
+
+def or_opt(rows, order):
+    """Move short segments of the path to better place, return True if improved"""
+    improved = False
+    found = True
+    while found:
+        found = False
+        for seg_len in range(1, OR_OPT_SEGMENT + 1):
+            for i in range(1, len(order) - seg_len):
+                first, last = order[i], order[i + seg_len - 1]
+                prev, nxt = order[i - 1], order[i + seg_len]
+                gain = rows[prev][first] + rows[last][nxt] - rows[prev][nxt]
+
+                for j in range(len(order) - 1):
+                    if i - 1 <= j < i + seg_len:
+                        continue
+                    p, q = order[j], order[j + 1]
+                    forward = rows[p][first] + rows[last][q] - rows[p][q]
+                    backward = rows[p][last] + rows[first][q] - rows[p][q]
+                    if min(forward, backward) - gain < -EPSILON:
+                        segment = order[i:i + seg_len]
+                        if backward < forward:
+                            segment.reverse()
+                        rest = order[:i] + order[i + seg_len:]
+                        at = j + 1 if j < i else j + 1 - seg_len
+                        order[:] = rest[:at] + segment + rest[at:]
+                        found = improved = True
+                        break
+                if found:
+                    break
+            if found:
+                break
+
+    return improved
+
+
+def improve(rows, order):
+    """Apply 2-opt and or-opt until none of them finds shorter path"""
+    while two_opt(rows, order) | or_opt(rows, order):
+        pass
+
+    return order
+
+
+def heuristic_path(rows, start, poi, finish):
+    """Good, but not guaranteed shortest path, returns length and order"""
+    order = improve(rows, nearest_neighbour(rows, start, poi, finish))
+
+    return path_length(rows, order), tuple(order)
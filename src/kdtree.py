@@ -0,0 +1,126 @@
+"""
+KD-tree over points with x, y, z for neighbour queries
+
+Built once per list of points. Answers k nearest and within radius
+queries without computing distances to every point. Queries return
+(distance, index) pairs, index is position of the point in the list
+given to the tree.
+"""
+from __future__ import print_function
+
+import heapq
+import math
+
+import numpy
+
+# max number of points in the leaf, leaves are scanned with numpy
+LEAF_SIZE = 16
+
+
+class KDTree(object):
+    """Static KD-tree, every node splits its points by median of the widest axis"""
+    def __init__(self, points, leaf_size=LEAF_SIZE):
+        self._points = list(points)
+        self._coords = numpy.array([(each.x, each.y, each.z) for each in self._points],
+                                   dtype=numpy.float64).reshape(-1, 3)
+        self._leaf_size = max(leaf_size, 1)
+        # positions of points, every node owns a slice of it
+        self._order = numpy.arange(len(self._points))
+        # leaf is (None, start, end), other node is (axis, split, left, right)
+        self._nodes = []
+        if self._points:
+            self._build(0, len(self._points))
+
+    def __len__(self):
+        return len(self._points)
+
+    @property
+    def points(self):
+        return self._points
+
+    def _build(self, start, end):
+        indx = len(self._nodes)
+        self._nodes.append(None)
+        if end - start <= self._leaf_size:
+            self._nodes[indx] = (None, start, end)
+            return indx
+
+        coords = self._coords[self._order[start:end]]
+        axis = int((coords.max(axis=0) - coords.min(axis=0)).argmax())
+        middle = (end - start) // 2
+        part = coords[:, axis].argpartition(middle)
+        self._order[start:end] = self._order[start:end][part]
+        split = float(self._coords[self._order[start + middle], axis])
+
+        left = self._build(start, start + middle)
+        right = self._build(start + middle, end)
+        self._nodes[indx] = (axis, split, left, right)
+        return indx
+
+    def _leaf(self, node, target):
+        """Positions and squared distances of the points in the leaf"""
+        positions = self._order[node[1]:node[2]]
+        diff = self._coords[positions] - target
+        return positions, (diff * diff).sum(axis=1)
+
+    @staticmethod
+    def _target(point):
+        return numpy.array([point.x, point.y, point.z], dtype=numpy.float64)
+
+    def nearest(self, point, k=1):
+        """k nearest points, closest first"""
+        if not self._nodes or k <= 0:
+            return []
+
+        target = self._target(point)
+        # max heap of k best as (-squared distance, position)
+        best = []
+
+        def search(indx):
+            node = self._nodes[indx]
+            if node[0] is None:
+                positions, square = self._leaf(node, target)
+                for position, dist in zip(positions.tolist(), square.tolist()):
+                    if len(best) < k:
+                        heapq.heappush(best, (-dist, position))
+                    elif dist < -best[0][0]:
+                        heapq.heapreplace(best, (-dist, position))
+                return
+
+            axis, split, left, right = node
+            diff = target[axis] - split
+            near, far = (left, right) if diff < 0 else (right, left)
+            search(near)
+            # other side can not be closer than the split plane
+            if len(best) < k or diff * diff < -best[0][0]:
+                search(far)
+
+        search(0)
+        return sorted([(math.sqrt(-dist), position) for dist, position in best])
+
+    def within(self, point, radius):
+        """Points not further than radius, closest first"""
+        if not self._nodes or radius < 0:
+            return []
+
+        target = self._target(point)
+        limit = radius * radius
+        found = []
+        stack = [0]
+        while stack:
+            node = self._nodes[stack.pop()]
+            if node[0] is None:
+                positions, square = self._leaf(node, target)
+                inside = square <= limit
+                found.extend(zip(numpy.sqrt(square[inside]).tolist(), positions[inside].tolist()))
+                continue
+
+            axis, split, left, right = node
+            diff = target[axis] - split
+            # points equal to split are on the right
+            if diff < 0 or diff * diff <= limit:
+                stack.append(left)
+            if diff >= 0 or diff * diff <= limit:
+                stack.append(right)
+
+        return sorted(found)
@@ -0,0 +1,107 @@
+"""
+Local search for long paths (hundreds of poi)
+
+2-opt and or-opt passes evaluate all moves for one position at once with
+numpy, so every pass is O(n^2). Within time budget the best path is
+perturbed by double bridge move and improved again (iterated local search).
+First and last position (start and finish) never move.
+"""
+from __future__ import print_function
+
+import random
+import time
+
+import numpy
+
+from src.heuristics import EPSILON, OR_OPT_SEGMENT, nearest_neighbour
+
+
+def path_length(dist, order):
+    """Length of the path in given order over numpy distance matrix"""
+    return float(dist[order[:-1], order[1:]].sum())
+
+
+def two_opt_pass(dist, order):
+    """Best reversal for every position, return True if improved"""
+    improved = False
+    size = len(order)
+    for i in range(1, size - 2):
+        a, b = order[i - 1], order[i]
+        c, d = order[i + 1:size - 1], order[i + 2:]
+        delta = dist[a, c] + dist[b, d] - dist[a, b] - dist[c, d]
+        j = int(delta.argmin())
+        if delta[j] < -EPSILON:
+            j += i + 1
+            order[i:j + 1] = order[i:j + 1][::-1].copy()
+            improved = True
+
+    return improved
+
+
+def or_opt_pass(dist, order):
+    """Best place for every short segment, return True if improved"""
+    improved = False
+    for seg_len in range(1, OR_OPT_SEGMENT + 1):
+        i = 1
+        while i < len(order) - seg_len:
+            first, last = order[i], order[i + seg_len - 1]
+            prev, nxt = order[i - 1], order[i + seg_len]
+            gain = dist[prev, first] + dist[last, nxt] - dist[prev, nxt]
+
+            p, q = order[:-1], order[1:]
+            forward = dist[p, first] + dist[last, q] - dist[p, q]
+            backward = dist[p, last] + dist[first, q] - dist[p, q]
+            cost = numpy.minimum(forward, backward)
+            # edges next to and inside of the segment
+            cost[i - 1:i + seg_len] = numpy.inf
+
+            j = int(cost.argmin())
+            if cost[j] - gain < -EPSILON:
+                segment = order[i:i + seg_len].copy()
+                if backward[j] < forward[j]:
+                    segment = segment[::-1]
+                rest = numpy.concatenate((order[:i], order[i + seg_len:]))
+                at = j + 1 if j < i else j + 1 - seg_len
+                order[:] = numpy.concatenate((rest[:at], segment, rest[at:]))
+                improved = True
+            i += 1
+
+    return improved
+
+
+def optimize(dist, order):
+    """Apply 2-opt and or-opt passes until none of them finds shorter path"""
+    while two_opt_pass(dist, order) | or_opt_pass(dist, order):
+        pass
+
+    return order
+
+
+def double_bridge(order, rnd):
+    """Swap two middle parts of the path, this is not undone by 2-opt or or-opt"""
+    cut = sorted(rnd.sample(range(1, len(order) - 1), 3))
+    return numpy.concatenate((order[:cut[0]], order[cut[1]:cut[2]],
+                              order[cut[0]:cut[1]], order[cut[2]:]))
+
+
+def local_search(dist, start, poi, finish, time_budget, seed=None):
+    """
+    Good path for long list of poi, returns length and order.
+
+    Path is improved until time budget (seconds) runs out.
+    """
+    dist = numpy.asarray(dist, dtype=numpy.float64)
+    order = numpy.array(nearest_neighbour(dist.tolist(), start, poi, finish), dtype=numpy.intp)
+    best = optimize(dist, order)
+    best_len = path_length(dist, best)
+
+    rnd = random.Random(seed)
+    deadline = time.time() + time_budget
+    # double bridge needs three poi
+    while len(poi) >= 3 and time.time() < deadline:
+        order = optimize(dist, double_bridge(best, rnd))
+        length = path_length(dist, order)
+        if length < best_len - EPSILON:
+            best, best_len = order, length
+
+    return best_len, tuple([int(x) for x in best])
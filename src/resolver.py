@@ -0,0 +1,156 @@
+"""
+Coordinates of systems by name: offline galaxy index and file cache
+first, then EDSM in bulk
+
+All names of a route are resolved together, unknown ones are fetched
+BATCH at a time from the multi system endpoint over one HTTP session.
+"""
+from __future__ import print_function, unicode_literals
+
+import json
+import os
+import time
+
+import requests
+
+from src.filecache import FileCache
+from src.galaxy import GALAXY_FILE, GalaxyIndex
+
+API_SYSTEMS = 'https://www.edsm.net/api-v1/systems'
+# names in one request
+BATCH = 50
+# be polite, seconds between requests
+DELAY = 3
+# timed out requests and busy or failed server responses are repeated this
+# number of times, first after BACKOFF seconds, then twice longer every time.
+# Unreachable server fails at once: most likely there is no network
+RETRIES = 2
+BACKOFF = 1
+# seconds to wait for the response
+TIMEOUT = 30
+
+
+class CoordsCache(FileCache):
+    """EDSM response for the system, keyed by name of the system"""
+    NAMESPACE = 'coords'
+    VERSION = 0
+
+
+class RateLimiter(object):
+    """Keeps at least interval seconds between requests which reached the server"""
+    def __init__(self, interval):
+        self.interval = interval
+        self._last = None
+
+    def wait(self):
+        """Sleep until interval passes since the last request"""
+        if self._last is not None:
+            delay = self._last + self.interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def done(self):
+        self._last = time.time()
+
+
+class Resolver(object):
+    """Resolve names of systems to coordinates, see resolve()"""
+    def __init__(self, url=API_SYSTEMS, delay=DELAY, retries=RETRIES, backoff=BACKOFF, galaxy=None):
+        self.url = url
+        # GalaxyIndex, None when there is no offline index
+        self.galaxy = galaxy
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = RateLimiter(delay)
+        self.session = requests.Session()
+        # number of requests sent, for statistics
+        self.requests = 0
+
+    @staticmethod
+    def _cache(name):
+        cache = CoordsCache(None)
+        cache.key = name.encode('utf-8')
+        return cache
+
+    @staticmethod
+    def _valid(name, data):
+        return isinstance(data, dict) and name.lower() == data.get('name', '').lower() and 'coords' in data
+
+    def resolve(self, names):
+        """
+        Get coordinates {'x':, 'y':, 'z':} for every name.
+
+        Raises RuntimeError if EDSM does not know some of the systems.
+        """
+        ret = {}
+        missing = []
+        for name in names:
+            if name in ret or name in missing:
+                continue
+            coords = self.galaxy.find(name) if self.galaxy else None
+            if coords:
+                ret[name] = coords
+                continue
+            with self._cache(name).open() as f:
+                data = json.load(f) if f else None
+            if self._valid(name, data):
+                ret[name] = data['coords']
+            else:
+                missing.append(name)
+
+        for indx in range(0, len(missing), BATCH):
+            batch = missing[indx:indx + BATCH]
+            print('Connecting to EDSM for %d systems [%s]' % (len(batch), ', '.join(batch)))
+            # EDSM may return other case of the name
+            found = {x.get('name', '').lower(): x for x in self._fetch(batch)}
+            for name in batch:
+                data = found.get(name.lower())
+                if self._valid(name, data):
+                    self._cache(name).save(json.dumps(data))
+                    ret[name] = data['coords']
+
+        unknown = [x for x in missing if x not in ret]
+        if unknown:
+            raise RuntimeError('Unknown systems: %s' % ', '.join(unknown))
+
+        return ret
+
+    def _fetch(self, names):
+        """List of systems with coordinates from EDSM"""
+        params = [('systemName[]', x.encode('utf-8')) for x in names] + [('showCoordinates', 1)]
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            self.limiter.wait()
+            self.requests += 1
+            try:
+                r = self.session.get(self.url, params=params, timeout=TIMEOUT)
+            except requests.Timeout as e:
+                self.limiter.done()
+                print('ERROR: %s' % e)
+                if attempt == self.retries:
+                    raise
+                continue
+            self.limiter.done()
+
+            if r.status_code == 200:
+                data = r.json()
+                # EDSM returns empty object when no system is found
+                return data if isinstance(data, list) else []
+            print('ERROR: status %s is not 200' % r.status_code)
+            # too many requests or server error may pass
+            if r.status_code != 429 and r.status_code < 500:
+                break
+
+        raise RuntimeError('EDSM request failed with status %s' % r.status_code)
+
+
+_DEFAULT = None
+
+
+def default_resolver():
+    """Resolver shared by all systems of this process"""
+    global _DEFAULT
+    if _DEFAULT is None:
+        _DEFAULT = Resolver(galaxy=GalaxyIndex() if os.path.exists(GALAXY_FILE) else None)
+    return _DEFAULT
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Route files: one poi per line, first is start and last is finish
+
+Line is 'name', 'name / alias' or 'alias - GalMap Ref: name', poi is
+minor when name or alias starts or ends with _. Lines starting with #
+are comments, the ones ending with : or ; are section headers
+('# Arrive at:'). parse() reads any iterable of lines lazily, load()
+resolves coordinates in batches while the rest of the file is still
+being read.
+"""
+from __future__ import print_function, unicode_literals
+
+from collections import namedtuple
+
+from src import resolver
+from src.edsystems import System, mSystem
+
+GALMAP = '- GalMap Ref:'
+
+# section is the last header above the poi, line is number of the line from 1
+Poi = namedtuple('Poi', ['name', 'alias', 'minor', 'section', 'line'])
+
+
+def _text(line):
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    return line.lstrip('\ufeff').strip()
+
+
+def _header(comment):
+    """Title of '# Title:' or '# Title;' line, None for other comments and commented out poi"""
+    if GALMAP in comment or '/' in comment or comment[-1] not in ':;':
+        return None
+    return comment.lstrip('#').strip().rstrip(':;').strip() or None
+
+
+def parse_line(line):
+    """Name, alias and minor flag of the poi, None for empty line and comment"""
+    line = _text(line)
+    if not line or line[0] == '#':
+        return None
+
+    line = line.replace('–', '-')
+    if GALMAP in line:
+        arr = [x.strip() for x in line.replace(GALMAP, '/').split('/', 2)]
+        arr.reverse()
+    else:
+        arr = [x.strip() for x in line.split('/', 2)]
+
+    minor = False
+    for indx, elem in enumerate(arr):
+        if elem[0] == '_' or elem[-1] == '_':
+            minor = True
+            arr[indx] = elem.strip('_ ')
+
+    return arr[0], arr[1] if len(arr) > 1 else arr[0], minor
+
+
+def parse(lines):
+    """Poi of the route, one at a time as lines are read"""
+    section = None
+    for number, line in enumerate(lines, 1):
+        text = _text(line)
+        if text[:1] == '#':
+            section = _header(text) or section
+            continue
+
+        poi = parse_line(text)
+        if poi:
+            yield Poi(poi[0], poi[1], poi[2], section, number)
+
+
+def system(poi):
+    """System or mSystem without coordinates for the poi"""
+    cls = mSystem if poi.minor else System
+    if poi.alias == poi.name:
+        return cls(name=poi.name)
+    return cls(name=poi.name, alias=poi.alias)
+
+
+def load(lines, batch=resolver.BATCH):
+    """Systems of the route with coordinates, batch of them is resolved at once"""
+    ret = []
+    todo = []
+    for poi in parse(lines):
+        todo.append(system(poi))
+        if len(todo) >= batch:
+            System.load_all(todo)
+            ret.extend(todo)
+            todo = []
+
+    System.load_all(todo)
+    return ret + todo
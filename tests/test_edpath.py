@@ -1,17 +1,67 @@
 # pylint: disable=missing-docstring
 from __future__ import print_function
 
+import BaseHTTPServer
+import contextlib
 import copy
+import gzip
+import itertools
+import json
 import math
+import multiprocessing
+import os
+import pickle
+import random
+import shutil
 import string
+import tempfile
+import threading
 import time
 import unittest
+import urlparse
 
+import numpy
+
+from src import costs, edpath, galaxy, resolver, routefile
+from src.distmatrix import DistanceMatrix
 from src.edpath import Distance
-from src.edsystems import Coords, System
+from src.edsystems import Coords, System, mSystem
+from src.filecache import FileCache, MemCache
+from src.heuristics import heuristic_path, nearest_neighbour, path_length, two_opt
+from src.kdtree import KDTree
+from src.resolver import CoordsCache
+
+
+def _random_route(prefix, n, seed, spread=1000, flat=False):
+    """n systems in a box of +-spread ly, ten times thinner along z or flat"""
+    rnd = random.Random(seed)
+    return [System(name='%s%d' % (prefix, i), coords=Coords(rnd.uniform(-spread, spread),
+                                                           rnd.uniform(-spread, spread),
+                                                           0 if flat else rnd.uniform(-spread / 10, spread / 10)))
+            for i in range(n)]
 
 
 class TestEDPath(unittest.TestCase):
+    @contextlib.contextmanager
+    def _file_cache(self, batch=None, **tunables):
+        """Temporary file cache and edpath tunables for the block, yields the directory"""
+        tmp = tempfile.mkdtemp()
+        saved = FileCache.CACHE_FILE, FileCache.BATCH
+        saved_tunables = {k: getattr(edpath, k) for k in tunables}
+        try:
+            FileCache.close()
+            FileCache.CACHE_FILE = os.path.join(tmp, 'cache.sqlite')
+            FileCache.BATCH = batch or FileCache.BATCH
+            for k, v in tunables.items():
+                setattr(edpath, k, v)
+            yield tmp
+        finally:
+            FileCache.close()
+            FileCache.CACHE_FILE, FileCache.BATCH = saved
+            for k, v in saved_tunables.items():
+                setattr(edpath, k, v)
+            shutil.rmtree(tmp)
+
     def test_distance(self):
         x = Coords(0, 0, 0)
         y = Coords(1, 1, 1)
@@ -19,6 +69,36 @@ class TestEDPath(unittest.TestCase):
         self.assertAlmostEqual(math.sqrt(3), x.distance_to(y))
         self.assertAlmostEqual(math.sqrt(81+361+841), y.distance_to(z))
 
+    def test_system_record(self):
+        one = System('Sol', coords=Coords(1, 2, 3))
+        same = mSystem('Sol', alias='Home', coords=Coords(4, 5, 6))
+        self.assertEqual(one, same)
+        self.assertFalse(one != same)
+        self.assertEqual(1, len({one, same}))
+        self.assertNotEqual(one, Coords(1, 2, 3))
+        self.assertEqual('_Home', same.alias)
+
+        self.assertRaises(AttributeError, setattr, one, 'x', 0)
+        self.assertRaises(AttributeError, setattr, one, 'other', 0)
+        self.assertFalse(hasattr(one, '__dict__'))
+
+        copied = pickle.loads(pickle.dumps(same, pickle.HIGHEST_PROTOCOL))
+        self.assertIsInstance(copied, mSystem)
+        self.assertEqual(('Sol', '_Home', 4), (copied.name, copied.alias, copied.x))
+
+    def test_distance_matrix(self):
+        x = Coords(0, 0, 0)
+        y = Coords(1, 1, 1)
+        z = Coords(10, 20, 30)
+        matrix = DistanceMatrix([x, y, z])
+        self.assertEqual(3, len(matrix))
+        self.assertEqual(2, matrix.index(z))
+        for a in (x, y, z):
+            for b in (x, y, z):
+                self.assertEqual(a.distance_to(b), matrix.distance(a, b))
+        self.assertEqual([[0, math.sqrt(1283)], [math.sqrt(1283), 0]],
+                         matrix.sub([1, 2]).tolist())
+
     def test_direct_path(self):
         x = Coords(0, 0, 0)
         y = Coords(1, 1, 1)
@@ -92,6 +172,690 @@ class TestEDPath(unittest.TestCase):
         
         # self.assertEqual(2, mypath.pcount)
 
+    def test_kdtree(self):
+        rnd = random.Random(3)
+        points = [Coords(rnd.uniform(-100, 100), rnd.uniform(-100, 100), rnd.uniform(-10, 10))
+                  for _ in range(300)]
+        # same points are split between leaves
+        points += [Coords(1, 1, 1)] * 40
+        tree = KDTree(points, leaf_size=8)
+
+        for target in points[:20] + [Coords(500, 0, 0), Coords(1, 1, 1)]:
+            expected = sorted([(target.distance_to(x), i) for i, x in enumerate(points)])
+            found = tree.nearest(target, 5)
+            self.assertEqual(5, len(found))
+            for (a, _), (b, _) in zip(expected[:5], found):
+                self.assertAlmostEqual(a, b)
+
+            inside = [i for d, i in expected if d <= 30]
+            self.assertEqual(sorted(inside), sorted([i for _, i in tree.within(target, 30)]))
+
+        self.assertEqual(len(points), len(tree.nearest(points[0], 1000)))
+        self.assertEqual([], KDTree([]).nearest(points[0], 3))
+
+    def test_exact_best_path(self):
+        arr = _random_route('hk', 9, 7)
+
+        brute = min(sum(a.distance_to(b) for a, b in zip(each, each[1:]))
+                    for each in [[arr[0]] + list(p) + [arr[-1]]
+                                 for p in itertools.permutations(arr[1:-1])])
+
+        best_len, best_order = Distance(arr).best_path(method='exact')
+        self.assertAlmostEqual(brute, best_len)
+        self.assertAlmostEqual(brute, Distance(best_order).len_path_asis)
+        self.assertEqual(arr[0], best_order[0])
+        self.assertEqual(arr[-1], best_order[-1])
+        self.assertSetEqual(set(x.name for x in arr), set(x.name for x in best_order))
+
+        # never worse than split heuristic
+        split_len, _ = Distance(arr).best_path()
+        self.assertLessEqual(best_len, split_len + 1e-9)
+
+    def test_exact_too_many_poi(self):
+        arr = _random_route('xb', 23, 1)
+        time_budget = edpath.TIME_BUDGET
+        edpath.TIME_BUDGET = 0.05
+        try:
+            dist = Distance(arr)
+            start = time.time()
+            found_len, found = dist.best_path(method='exact')
+        finally:
+            edpath.TIME_BUDGET = time_budget
+
+        # local search within its time budget, path is not proven shortest
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(len(arr), len(found))
+        self.assertAlmostEqual(found_len, Distance(found).len_path_asis)
+        self.assertLessEqual(found_len, Distance(arr).best_path(method='fast')[0] + 1e-6)
+        self.assertIsNone(dist.lower_bound)
+
+    def test_branch_and_bound(self):
+        arr = _random_route('bb', 8, 11)
+        exact_len, _ = Distance(arr).best_path(method='exact')
+
+        split_low_limit = edpath.SPLIT_LOW_LIMIT
+        edpath.SPLIT_LOW_LIMIT = len(arr)
+        try:
+            dist = Distance(arr)
+            best_len, best_order = dist.best_path()
+            self.assertAlmostEqual(exact_len, best_len)
+            self.assertAlmostEqual(best_len, Distance(best_order).len_path_asis)
+            self.assertGreater(dist.rcount, 0)
+
+            # nothing is shorter than the optimum (short path is not cached)
+            best_len, _ = Distance(arr[:4]).best_path()
+            self.assertEqual((best_len, None), Distance(arr[:4]).best_path(limit=best_len))
+        finally:
+            edpath.SPLIT_LOW_LIMIT = split_low_limit
+
+    def test_lower_bounds(self):
+        arr = _random_route('lb', 12, 17)
+        exact_len, _ = Distance(arr).best_path(method='exact')
+
+        dist = Distance(arr)
+        best_len, best_order = dist.best_path(method='bnb')
+        self.assertAlmostEqual(exact_len, best_len)
+        self.assertAlmostEqual(best_len, Distance(best_order).len_path_asis)
+        self.assertGreater(dist.rejected['mst'], 0)
+        self.assertLessEqual(sum(dist.rejected.values()), dist.rcount)
+
+        self.assertAlmostEqual(6.0, DistanceMatrix([Coords(0, 0, 0),
+                                                    Coords(3, 0, 0),
+                                                    Coords(0, 2, 0),
+                                                    Coords(3, 0, 1)]).mst_length([0, 1, 2, 3]))
+
+    def test_heuristic_path(self):
+        # zig-zag is uncrossed by 2-opt
+        line = DistanceMatrix([Coords(x, 0, 0) for x in (0, 2, 1, 3)])
+        order = [0, 1, 2, 3]
+        self.assertTrue(two_opt(line.rows, order))
+        self.assertEqual([0, 2, 1, 3], order)
+
+        arr = _random_route('hp', 16, 19)
+        rows = DistanceMatrix(arr).rows
+        poi = tuple(range(1, 15))
+        found_len, found_best = heuristic_path(rows, 0, poi, 15)
+        self.assertEqual(0, found_best[0])
+        self.assertEqual(15, found_best[-1])
+        self.assertSetEqual(set(poi), set(found_best[1:-1]))
+        self.assertAlmostEqual(found_len, path_length(rows, found_best))
+        self.assertLessEqual(found_len, path_length(rows, nearest_neighbour(rows, 0, poi, 15)))
+
+        exact_len, _ = Distance(arr).best_path(method='exact')
+        fast_len, fast_order = Distance(arr).best_path(method='fast')
+        self.assertAlmostEqual(found_len, fast_len)
+        self.assertGreaterEqual(fast_len, exact_len - 1e-9)
+        self.assertEqual(len(arr), len(fast_order))
+
+    def test_local_search(self):
+        arr = _random_route('ls', 80, 23, spread=5000)
+
+        fast_len, _ = Distance(arr).best_path(method='fast')
+
+        time_budget = edpath.TIME_BUDGET
+        edpath.TIME_BUDGET = 0.5
+        try:
+            dist = Distance(arr)
+            best_len, best_order = dist.best_path(method='local')
+        finally:
+            edpath.TIME_BUDGET = time_budget
+
+        self.assertLessEqual(best_len, fast_len + 1e-6)
+        self.assertAlmostEqual(best_len, Distance(best_order).len_path_asis)
+        self.assertEqual(arr[0], best_order[0])
+        self.assertEqual(arr[-1], best_order[-1])
+        self.assertSetEqual(set(x.name for x in arr), set(x.name for x in best_order))
+        self.assertGreater(best_len, dist._matrix.mst_length(range(len(arr))))
+
+        lower_bound, gap = dist.gap()
+        self.assertAlmostEqual(dist._matrix.mst_length(range(len(arr))), lower_bound)
+        self.assertAlmostEqual(100.0 * (best_len - lower_bound) / lower_bound, gap)
+        self.assertIsNone(Distance(arr).gap())
+
+    def test_poi_order(self):
+        arr = [System(name='po%d' % i, coords=Coords(x, i % 3, 0))
+               for i, x in enumerate([0, 40, 10, 30, 20, 50])]
+
+        dist = Distance(arr)
+        dist.sort_poi()
+        self.assertListEqual([0, 10, 20, 30, 40, 50], [x.x for x in dist.path])
+
+        first = Distance(arr, seed=5)
+        second = Distance(arr, seed=5)
+        first.shuffle_poi(first.seed)
+        second.shuffle_poi(second.seed)
+        self.assertListEqual([x.name for x in first.path], [x.name for x in second.path])
+
+    def test_split_keeps_equal_poi(self):
+        # mirrored poi have the same scaled distance between start and finish
+        arr = [System(name='sk%d' % i, coords=Coords(x, y, 0))
+               for i, (x, y) in enumerate([(0, 0), (20, 10), (20, -10), (50, 10),
+                                           (50, -10), (80, 5), (100, 0)])]
+
+        best_len, best_order = Distance(arr).best_path()
+        self.assertEqual(len(arr), len(best_order))
+        self.assertSetEqual(set(x.name for x in arr), set(x.name for x in best_order))
+        self.assertAlmostEqual(best_len, Distance(best_order).len_path_asis)
+
+        split_points = edpath.SPLIT_POINTS
+        edpath.SPLIT_POINTS = 1
+        try:
+            arr = [System(name='sp%d' % i, coords=Coords(each.x, each.y, each.z))
+                   for i, each in enumerate(arr)]
+            best_len, best_order = Distance(arr).best_path()
+        finally:
+            edpath.SPLIT_POINTS = split_points
+        self.assertEqual(len(arr), len(best_order))
+        self.assertAlmostEqual(best_len, Distance(best_order).len_path_asis)
+
+    def test_mirrored_cache_key(self):
+        arr = _random_route('mk', 9, 7, spread=50, flat=True)
+
+        there = Distance(arr)
+        there.sort_poi()
+        key, reverse = there._sub_cache_key(0, tuple(range(1, 8)), 8)
+        self.assertEqual((key, not reverse), there._sub_cache_key(8, tuple(range(7, 0, -1)), 0))
+        there_len, _ = there.best_path()
+
+        hits = MemCache.hits
+        back = Distance(arr[::-1])
+        back.sort_poi()
+        back_len, back_order = back._best_path(0, tuple(range(1, 8)), 8)
+        self.assertEqual(hits + 1, MemCache.hits)
+        self.assertAlmostEqual(there_len, back_len)
+        self.assertEqual(0, back_order[0])
+        self.assertEqual(8, back_order[-1])
+        self.assertAlmostEqual(back_len, back._path_len(back_order))
+
+    def test_cached_lower_bound(self):
+        arr = [System(name='lb%d' % i, coords=Coords(x, y, 0))
+               for i, (x, y) in enumerate([(0, 0), (10, 5), (20, -5), (30, 5), (40, 0)])]
+        dist = Distance(arr)
+        poi = (1, 2, 3)
+
+        reads = MemCache.reads
+        self.assertIsNone(dist._best_path(0, poi, 4, limit=30)[1])
+        searched = dist.pcount + dist.rcount
+        # bound is not a sub path cache entry
+        self.assertEqual(30, edpath._LOWER_BOUNDS[dist._sub_cache_key(0, poi, 4)[0]])
+        self.assertIsNone(dist._best_path(0, poi, 4, limit=20)[1])
+        self.assertEqual(6, dist.rejected['cached'])
+        self.assertEqual(searched + 6, dist.pcount + dist.rcount)
+        self.assertEqual(reads + 2, MemCache.reads)
+
+        # limit above proven bound is searched again
+        best_len, best_order = dist._best_path(0, poi, 4, limit=100)
+        self.assertAlmostEqual(dist._path_len(best_order), best_len)
+        self.assertEqual(6, dist.rejected['cached'])
+
+    def test_candidates(self):
+        arr = _random_route('cl', 12, 11, spread=50, flat=True)
+        exact_len, _ = Distance(arr).best_path(method='exact')
+
+        candidates = edpath.CANDIDATES
+        edpath.CANDIDATES = 4
+        try:
+            dist = Distance(arr)
+            found_len, found = dist.best_path(method='bnb')
+            self.assertGreater(dist.rejected['candidates'], 0)
+            self.assertIsNone(dist.lower_bound)
+            self.assertEqual(len(arr), len(found))
+            self.assertAlmostEqual(found_len, Distance(found).len_path_asis)
+            self.assertGreaterEqual(found_len, exact_len - 1e-9)
+
+            # KD-tree finds the same neighbours as sorting the whole row
+            poi = tuple(range(1, 11))
+            rows = dist._matrix.rows
+            self.assertEqual({x: sorted([y for y in poi if y != x], key=rows[x].__getitem__)[:4]
+                              for x in (0,) + poi}, dist._candidates(0, poi))
+
+            # 0 -> 1 -> 2 is a dead end for nearest only hops, all poi are searched then
+            edpath.CANDIDATES = 1
+            line = [System(name='cf%d' % i, coords=Coords(x, 0, 0)) for i, x in enumerate([0, 1, 2, 10, 11])]
+            dist = Distance(line)
+            found_len, found = dist._best_path(0, (1, 2, 3), 4, limit=100)
+            self.assertEqual((0, 1, 2, 3, 4), found)
+            self.assertAlmostEqual(11, found_len)
+        finally:
+            edpath.CANDIDATES = candidates
+
+    def test_cost_model(self):
+        arr = [System(name='cm%d' % i, coords=Coords(x, y, 0))
+               for i, (x, y) in enumerate([(0, 0), (100, 60), (100, 50), (80, 10), (50, 10), (120, 0)])]
+        lengths = numpy.array([0, 10, 50, 51, 120])
+        self.assertListEqual([0, 1, 1, 2, 3], costs.jumps(lengths).tolist())
+        self.assertListEqual([0, 165, 165, 210, 255], costs.travel_time(lengths).tolist())
+
+        saved = costs.NEUTRON_BOOST
+        costs.NEUTRON_BOOST = 4
+        try:
+            # 1000 ly is 20 jumps, or 5 boosted jumps plus detour to neutron stars
+            self.assertListEqual([7, 1], costs.jumps(numpy.array([1000, 50])).tolist())
+        finally:
+            costs.NEUTRON_BOOST = saved
+
+        by_ly = Distance(arr)
+        by_jumps = Distance(arr, cost='jumps')
+        self.assertEqual('jumps', by_jumps.cost)
+        # matrix keeps ly for printing
+        self.assertAlmostEqual(120, by_jumps._matrix.distance(arr[0], arr[5]))
+
+        def jumps(path):
+            return sum([math.ceil(a.distance_to(b) / costs.JUMP_RANGE) for a, b in zip(path, path[1:])])
+
+        ly_len, ly_path = by_ly.best_path(method='exact')
+        jumps_len, path = by_jumps.best_path(method='exact')
+        # shortest path needs more jumps
+        self.assertEqual(8, jumps(ly_path))
+        self.assertEqual(7, jumps_len)
+        self.assertEqual(jumps_len, jumps(path))
+        self.assertNotEqual(by_ly._sub_cache_key(0, (1, 2, 3, 4), 5),
+                            by_jumps._sub_cache_key(0, (1, 2, 3, 4), 5))
+
+        table = Distance._make_table(path, 'jumps')
+        self.assertEqual('Cost', table[0][-1])
+        self.assertTrue(table[1][-1].endswith(' / 7 jumps'))
+        self.assertEqual(4, len(Distance._make_table(path)[0]))
+
+        self.assertRaises(ValueError, Distance, arr, cost='fuel')
+
+    def test_minor_budget(self):
+        def system(cls, name, x, y):
+            return cls(name='mb' + name, coords=Coords(x, y, 0))
+
+        # minor poi b is 1 ly off the line, c is 10 ly off, d is 30 ly off
+        arr = [system(System, 'start', 0, 0),
+               system(mSystem, 'd', 50, 30),
+               system(System, 'a', 40, 0),
+               system(mSystem, 'b', 60, 1),
+               system(mSystem, 'c', 20, 10),
+               system(System, 'finish', 100, 0)]
+        extra = {'b': math.hypot(20, 1) + math.hypot(40, 1) - 60, 'c': 2 * math.hypot(20, 10) - 40}
+
+        def names(path):
+            return [x.name[2:] for x in path]
+
+        route = Distance(arr)
+        length, path = route.best_path_with_minor(budget=0)
+        self.assertAlmostEqual(100, length)
+        self.assertListEqual(['start', 'a', 'finish'], names(path))
+        self.assertListEqual(['b', 'c', 'd'], sorted(names(route.dropped)))
+
+        length, path = route.best_path_with_minor(budget=10)
+        self.assertAlmostEqual(100 + extra['b'] + extra['c'], length)
+        self.assertListEqual(['start', 'c', 'a', 'b', 'finish'], names(path))
+        self.assertListEqual(['d'], names(route.dropped))
+
+        length, path = route.best_path_with_minor(detour=1)
+        self.assertListEqual(['start', 'a', 'b', 'finish'], names(path))
+
+        # no limit is the same as the path over all poi
+        length, path = route.best_path_with_minor()
+        self.assertAlmostEqual(Distance(arr).best_path(method='exact')[0], length)
+        self.assertListEqual([], route.dropped)
+
+    def test_workers(self):
+        def route(prefix):
+            return _random_route(prefix, 12, 13)
+
+        serial_len, serial_order = Distance(route('ws')).best_path()
+
+        workers = edpath.WORKERS
+        edpath.WORKERS = 2
+        try:
+            best_len, best_order = Distance(route('wp')).best_path()
+            self.assertAlmostEqual(serial_len, best_len)
+            self.assertListEqual([x.name[2:] for x in serial_order],
+                                 [x.name[2:] for x in best_order])
+
+            # first hops of branch and bound
+            exact_len, _ = Distance(route('we')).best_path(method='exact')
+            split_low_limit = edpath.SPLIT_LOW_LIMIT
+            edpath.SPLIT_LOW_LIMIT = 12
+            try:
+                best_len, _ = Distance(route('wb')).best_path()
+            finally:
+                edpath.SPLIT_LOW_LIMIT = split_low_limit
+            self.assertAlmostEqual(exact_len, best_len)
+        finally:
+            edpath.WORKERS = workers
+
+    def test_shared_bound(self):
+        for shared in (False, True):
+            bound = edpath._Bound(shared=shared)
+            self.assertEqual(0, bound.value)
+            bound.update(10.5)
+            bound.update(12)
+            self.assertEqual(10.5, bound.value)
+            bound.update(3)
+            self.assertEqual(3, bound.value)
+
+    def test_mem_cache_eviction(self):
+        names = ('cache', 'hit', 'miss', 'time_spent', 'priority', 'size', '_heap')
+        saved = {name: getattr(MemCache, name) for name in names}
+        saved_limits = MemCache.MAX_ENTRIES, MemCache.total_size
+        try:
+            for name in names:
+                setattr(MemCache, name, type(saved[name])())
+            MemCache.MAX_ENTRIES, MemCache.total_size = 2, 0
+
+            cheap = MemCache('evict cheap')
+            self.assertIsNone(cheap.read())
+            # nothing is stored before save
+            self.assertEqual(0, len(MemCache.cache))
+            cheap.save('cheap', 0.01)
+            costly = MemCache('evict costly')
+            costly.save('costly', 10)
+            self.assertEqual('cheap', cheap.read())
+
+            MemCache('evict new').save('new', 1)
+            self.assertEqual(2, len(MemCache.cache))
+            self.assertIsNone(cheap.read())
+            self.assertEqual('costly', costly.read())
+            self.assertEqual(set(MemCache.cache), set(MemCache.size))
+
+            # same value again is fine
+            costly.save('costly', 10)
+            self.assertRaises(ValueError, costly.save, 'other', 10)
+
+            # reads do not grow the heap without limit
+            for _ in range(1000):
+                costly.read()
+            self.assertLessEqual(len(MemCache._heap), 2 * len(MemCache.cache))
+            self.assertEqual(set(MemCache.cache), set([k for _, k in MemCache._heap]))
+            self.assertGreater(MemCache.size[costly._key], MemCache.ENTRY_OVERHEAD)
+            self.assertEqual(sum(MemCache.size.values()), MemCache.total_size)
+        finally:
+            for name in names:
+                setattr(MemCache, name, saved[name])
+            MemCache.MAX_ENTRIES, MemCache.total_size = saved_limits
+
+    def test_file_cache(self):
+        with self._file_cache(batch=2) as tmp:
+            coords = CoordsCache(None)
+            coords.key = b'Sol'
+            data = FileCache(None)
+            data.key = b'Sol'
+            coords.save('{"name": "Sol"}')
+            # not flushed yet
+            with data.open() as f:
+                self.assertIsNone(f)
+            with coords.open() as f:
+                self.assertEqual({'name': 'Sol'}, json.load(f))
+
+            data.save('data')
+            FileCache.close()
+            with coords.open() as f:
+                self.assertEqual({'name': 'Sol'}, json.load(f))
+            with data.open() as f:
+                self.assertEqual('data', f.read())
+
+            FileCache.clear('coords')
+            with coords.open() as f:
+                self.assertIsNone(f)
+            data.remove()
+            with data.open() as f:
+                self.assertIsNone(f)
+
+            # old cache tree
+            os.makedirs(os.path.join(tmp, 'tree', 'ab'))
+            with open(os.path.join(tmp, 'tree', 'ab', 'cdef'), 'w') as f:
+                f.write('{"found_len": 1}')
+            self.assertEqual(1, FileCache.import_tree(os.path.join(tmp, 'tree')))
+            paths = FileCache(None)
+            paths.NAMESPACE = 'paths'
+            paths._key = 'abcdef'
+            with paths.open() as f:
+                self.assertEqual('{"found_len": 1}', f.read())
+
+    def test_file_cache_processes(self):
+        with self._file_cache(batch=7):
+            def write(n):
+                cache = FileCache(None)
+                for i in range(100):
+                    cache.key = str(i)
+                    cache.save('%d-%d' % (n, i))
+                FileCache.close()
+
+            procs = [multiprocessing.Process(target=write, args=(n,)) for n in range(4)]
+            for each in procs:
+                each.start()
+            for each in procs:
+                each.join()
+            self.assertEqual([0] * len(procs), [x.exitcode for x in procs])
+            self.assertEqual(100, FileCache.stats()['data']['entries'])
+
+    def test_cache_versions(self):
+        with self._file_cache(PATH_CACHE=True):
+            arr = [System(name='cv%d' % i, coords=Coords(x, i % 2, 0))
+                   for i, x in enumerate([0, 30, 10, 20, 40])]
+            first = Distance(arr)
+            found_len, found_best = first.best_path()
+            FileCache.flush()
+            self.assertEqual({'entries': 1, 'stale': 0},
+                             {k: v for k, v in FileCache.stats()['paths'].items()
+                              if k in ('entries', 'stale')})
+
+            second = Distance(arr)
+            self.assertEqual((found_len, found_best), second.best_path())
+            self.assertEqual(0, second.pcount)
+
+            # other solver version does not read the path
+            stale = edpath.PathCache(None)
+            stale.VERSION = edpath.PathCache.VERSION + 1
+            stale.key = second._route_name('split')
+            with stale.open() as f:
+                self.assertIsNone(f)
+            versions = {'paths': stale.VERSION}
+            self.assertEqual(1, FileCache.stats(versions)['paths']['stale'])
+            self.assertEqual(1, FileCache.prune(versions=versions))
+            self.assertNotIn('paths', FileCache.stats())
+
+            data = FileCache(None)
+            data.key = b'old'
+            data.save('x' * 100)
+            data.key = b'new'
+            data.save('y' * 100)
+            self.assertEqual(1, FileCache.prune('data', max_bytes=150))
+            with data.open() as f:
+                self.assertEqual('y' * 100, f.read())
+            self.assertEqual(1, FileCache.prune('data', max_age=-1))
+            FileCache.compact()
+
+    def test_path_cache_settings(self):
+        with self._file_cache(PATH_CACHE=True, SPLIT_POINTS=None, TIME_BUDGET=edpath.TIME_BUDGET):
+            arr = _random_route('pcs', 12, 5)
+
+            def entries():
+                FileCache.flush()
+                return FileCache.stats().get('paths', {}).get('entries', 0)
+
+            edpath.SPLIT_POINTS = 1
+            limited = Distance(arr)
+            limited.best_path()
+            self.assertEqual(1, entries())
+
+            # path found with other settings is not read, both are stored
+            edpath.SPLIT_POINTS = None
+            full = Distance(arr)
+            full.best_path()
+            self.assertEqual(2, entries())
+            self.assertNotEqual(full._route_name('split'), Distance(arr, seed=1)._route_name('split'))
+            again = Distance(arr)
+            self.assertEqual(full.best_path(), again.best_path())
+            self.assertEqual(2, entries())
+
+            edpath.TIME_BUDGET = 0.01
+            for _ in range(2):
+                local = Distance(arr)
+                local.best_path(method='local')
+                self.assertEqual(1, local.pcount)
+            self.assertEqual(2, entries())
+
+    def test_resolver(self):
+        known = {'Sol': (0, 0, 0), 'Alpha Centauri': (3.03, -0.09, 3.16), 'Barnard\'s Star': (-3.03, 1.38, 4.94),
+                 'Wolf 359': (3.88, 6.91, 2.87), 'Ross 128': (0.5, 10.9, 0.16), 'Luyten 726-8': (-2.47, -8.56, 0.2)}
+        requests_seen = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+                requests_seen.append(query.get('systemName[]', []))
+                if len(requests_seen) == 1:
+                    # first request fails and is repeated
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                body = json.dumps([{'name': x.upper(), 'coords': dict(zip('xyz', known[x]))}
+                                   for x in query.get('systemName[]', []) if x in known])
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        saved = resolver._DEFAULT
+        try:
+            with self._file_cache():
+                resolver._DEFAULT = resolver.Resolver('http://127.0.0.1:%d/api-v1/systems' % server.server_port,
+                                                      delay=0, backoff=0)
+
+                dist = Distance(b'Sol\nAlpha Centauri / Rigil\nBarnard\'s Star\n')
+                self.assertEqual(['Alpha Centauri', "Barnard's Star"], [x.name for x in dist.path[1:]])
+                self.assertEqual('Rigil', dist.path[1].alias)
+                self.assertAlmostEqual(3.03, dist.path[1].x)
+                # all systems in one request, repeated once
+                self.assertEqual(2, len(requests_seen))
+                self.assertEqual(sorted(["Sol", "Alpha Centauri", "Barnard's Star"]), sorted(requests_seen[1]))
+
+                # then from the cache
+                self.assertAlmostEqual(4.94, System("Barnard's Star").z)
+                self.assertEqual(2, len(requests_seen))
+
+                # list of systems is loaded in one request too
+                dist = Distance([System('Wolf 359'), System('Ross 128'), System('Luyten 726-8')])
+                self.assertEqual(3, len(requests_seen))
+                self.assertAlmostEqual(10.9, dist.path[1].y)
+
+                # coordinates are loaded on first use
+                nowhere = System('Nowhere')
+                self.assertEqual('System(name=Nowhere, coords=?)', repr(nowhere))
+                self.assertEqual(3, len(requests_seen))
+                self.assertFalse(nowhere.loaded)
+                self.assertRaises(RuntimeError, getattr, nowhere, 'x')
+        finally:
+            server.shutdown()
+            server.server_close()
+            resolver._DEFAULT = saved
+
+    def test_galaxy_index(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            dump = os.path.join(tmp, 'systems.json.gz')
+            systems = [{'name': 'Sol', 'coords': {'x': 0, 'y': 0, 'z': 0}},
+                       {'name': 'Wolf 397', 'coords': {'x': 40, 'y': 79.21875, 'z': -10.40625}},
+                       {'name': 'Achenar', 'coords': {'x': 67.5, 'y': -119.46875, 'z': 24.84375}},
+                       {'name': 'SOL', 'coords': {'x': 1, 'y': 1, 'z': 1}},
+                       {'name': 'No Coords'},
+                       {'name': 'Shinrarta Dezhra', 'coords': {'x': 55.71875, 'y': 17.59375, 'z': 27.15625}},
+                       {'name': 'Foo', 'coords': {'x': 5, 'y': 5, 'z': 5}},
+                       {'name': 'foo', 'coords': {'x': 1, 'y': 1, 'z': 1}}]
+            f = gzip.open(dump, 'wb')
+            f.write('[\n' + ',\n'.join(['    ' + json.dumps(x) for x in systems]) + '\n]\n')
+            f.close()
+
+            fname = os.path.join(tmp, 'galaxy.idx')
+            # small chunks are merged
+            self.assertEqual(5, galaxy.import_dump(dump, fname, chunk_size=2))
+
+            index = galaxy.GalaxyIndex(fname)
+            self.assertEqual(5, len(index))
+            # first one in the dump wins
+            self.assertEqual({'x': 5, 'y': 5, 'z': 5}, index.find('FOO'))
+            self.assertEqual({'x': 40, 'y': 79.21875, 'z': -10.40625}, index.find('wolf 397'))
+            self.assertEqual({'x': 0, 'y': 0, 'z': 0}, index.find('Sol'))
+            self.assertIsNone(index.find('No Coords'))
+            self.assertIsNone(index.find('Zzz'))
+            self.assertIsNone(index.find('A'))
+
+            # no network is needed
+            offline = resolver.Resolver('http://127.0.0.1:1/', galaxy=index)
+            self.assertAlmostEqual(67.5, offline.resolve(['Achenar', 'Sol'])['Achenar']['x'])
+            self.assertEqual(0, offline.requests)
+            index.close()
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_route_file(self):
+        with open('tests/resources/WP9TO10.txt', 'rb') as f:
+            records = list(routefile.parse(f))
+        self.assertEqual(10, len(records))
+        self.assertEqual(('Phroi Bluae QI-T e3-3454', 'Cerulean Tranquility', False, None, 1), records[0])
+        self.assertEqual('To see on the way', records[1].section)
+        self.assertEqual(('Phroi Bluae LS-B d13-744', 'Undine Haven', True, "Minor POI's (off-route)", 10),
+                         records[5])
+        self.assertEqual(('Bleethuae NI-B D674', 'Morphenniel Nebula', False, 'Arrive at', 16), records[-1])
+
+        lines = [b'\xef\xbb\xbfSol\n',
+                 '# Major:\n',
+                 u'Colonia / Jaques \u2013 station\n',
+                 '#Marsha Hicks - GalMap Ref: Tir\n',
+                 '#Sagittarius A*\n',
+                 '_Beagle Point_\n',
+                 b'Ceos \xe2\x80\x93 GalMap Ref: Sothis\n']
+        read = []
+
+        def stream():
+            for each in lines:
+                read.append(each)
+                yield each
+
+        records = routefile.parse(stream())
+        self.assertEqual(('Sol', 'Sol', False, None, 1), next(records))
+        # lines are read only when they are needed
+        self.assertEqual(1, len(read))
+        # commented out poi are not headers
+        self.assertEqual([('Colonia', 'Jaques - station', False, 'Major', 3),
+                          ('Beagle Point', 'Beagle Point', True, 'Major', 6),
+                          ('Sothis', 'Ceos', False, 'Major', 7)], list(records))
+
+        tmp = tempfile.mkdtemp()
+        saved = resolver._DEFAULT
+        try:
+            dump = os.path.join(tmp, 'systems.json')
+            with open(dump, 'w') as f:
+                for indx, name in enumerate(['rf Start', 'rf Minor', 'rf Poi', 'rf Finish']):
+                    f.write(json.dumps({'name': name, 'coords': {'x': indx, 'y': 0, 'z': 0}}) + ',\n')
+            fname = os.path.join(tmp, 'galaxy.idx')
+            galaxy.import_dump(dump, fname)
+            index = galaxy.GalaxyIndex(fname)
+            resolver._DEFAULT = resolver.Resolver('http://127.0.0.1:1/', galaxy=index)
+
+            systems = routefile.load(['rf Start', 'rf Minor_', 'rf Poi / Poi', 'rf Finish'], batch=2)
+            self.assertListEqual([System, mSystem, System, System], [type(x) for x in systems])
+            self.assertTrue(all([x.loaded for x in systems]))
+            self.assertEqual('Poi', systems[2].alias)
+
+            with open(os.path.join(tmp, 'route.txt'), 'w') as f:
+                f.write('rf Start\n# Minor\nrf Minor_\n\nrf Finish\n')
+            with open(os.path.join(tmp, 'route.txt')) as f:
+                dist = Distance(f)
+            self.assertAlmostEqual(3, dist.len_path_asis)
+            self.assertEqual(0, resolver._DEFAULT.requests)
+            index.close()
+        finally:
+            resolver._DEFAULT = saved
+            shutil.rmtree(tmp)
+
+        self.assertRaises(ValueError, Distance, 42)
+
     def test_fast_tree(self):
         arr = [1, 2, 3, 4]
         amap = list(range(len(arr)))